@@ -0,0 +1,256 @@
+import json
+import random
+import string
+import time
+
+import redis
+
+import cli
+import utils
+from model import (CardBox, Card, TABLE_CARDBOXES, TABLE_RATINGS,
+                   TABLE_CONTENT, CONTENT_DICT_CURRENT, DEFAULT_INFO)
+
+# Benchmarks against a scratch redis database.
+# Usage: python benchmark.py <benchmark> [--db 15] [--boxes 100000]
+# 'content' compares plain json content blobs with zlib and zlib with a
+#   trained dictionary on generated content ('--boxes' / 100 of them).
+# 'serialization' compares json with utils.encode_record on generated box
+#   and user records ('--boxes' of them, a tenth as many users).
+# The chosen database has to be empty unless '--force' is given,
+#   since it is flushed after the benchmark.
+
+TAGS = ['maths', 'physics', 'chemistry', 'music', 'history', 'food',
+        'gaming', 'star_wars', 'cheese', 'veganism', '1984', 'owo']
+
+
+def _random_word(low=4, high=12) -> str:
+    return ''.join(random.choice(string.ascii_lowercase)
+                   for _ in range(random.randint(low, high)))
+
+
+def populate_boxes(db, number: int, owners=1000, batch_size=1000):
+    owner_names = [_random_word(3, 16) for _ in range(owners)]
+
+    pipe = db.pipeline(transaction=False)
+
+    for i in range(number):
+        box = CardBox(CardBox.gen_card_id(), name=_random_word(),
+                      owner=random.choice(owner_names),
+                      rating=random.randint(0, 500),
+                      tags=random.sample(TAGS, 2))
+
+        pipe.hset(TABLE_CARDBOXES, box._id, utils.jsonify(box))
+        pipe.hset(TABLE_RATINGS, box._id, box.rating)
+        box._index(pipe)
+
+        if i % batch_size == 0:
+            pipe.execute()
+
+    pipe.execute()
+
+    return owner_names
+
+
+def _timed(function, repeat: int):
+    start = time.perf_counter()
+
+    for _ in range(repeat):
+        result = function()
+
+    return (time.perf_counter() - start) / repeat, result
+
+
+def bench_search(db, args):
+    owner_names = populate_boxes(db, args.boxes)
+
+    terms = [('name', 'abc'), ('name', 'qu'), ('name', 'xyzw'),
+             ('owner', owner_names[0][:5]), ('owner', 'zz')]
+
+    for field, term in terms:
+        def linear_scan():
+            return [box._id for box in CardBox.fetch_all(db)
+                    if term.lower() in getattr(box, field).lower()]
+
+        def trigram_search():
+            return CardBox.search_ids(db, field, term)
+
+        t_linear, linear = _timed(linear_scan, args.repeat)
+        t_trigram, trigram = _timed(trigram_search, args.repeat)
+
+        assert sorted(linear) == sorted(trigram)
+
+        print(f'{field:>5} {term!r:>12}: {len(linear):>6} hits | '
+              f'linear scan {t_linear * 1000:9.2f} ms | '
+              f'trigram index {t_trigram * 1000:9.2f} ms')
+
+
+SERIALIZATIONS = {
+    'json': (lambda record: json.dumps(record).encode('utf-8'),
+             utils.unjsonify),
+    'record': (utils.encode_record, utils.decode_record),
+}
+
+
+def _random_box_record() -> dict:
+    return dict(_id=CardBox.gen_card_id(), name=_random_word(),
+                owner=_random_word(3, 16), tags=random.sample(TAGS, 2),
+                info=random.choice([DEFAULT_INFO, _random_word(20, 120)]))
+
+
+def _random_user_record(box_ids: list, user_ids: list) -> dict:
+    # the legacy user document, the largest record we ever stored
+    salt = _random_word(8, 8)
+    digest = ''.join(random.choice('0123456789abcdef') for _ in range(64))
+
+    return dict(_id=_random_word(3, 16),
+                password_hash=f'pbkdf2:sha256:50000${salt}${digest}',
+                cardboxs=random.sample(box_ids, random.randint(0, 20)),
+                rated=random.sample(box_ids, random.randint(0, 50)),
+                following=random.sample(user_ids, random.randint(0, 30)),
+                offline_score=random.randint(0, 10000),
+                showcase=dict(info=_random_word(0, 60), cardbox='',
+                              show_info=True, show_cardbox=False,
+                              show_rank=True),
+                is_active=True, is_authenticated=True, is_anonymous=False)
+
+
+def _memory_usage(db, key: str):
+    try:
+        return db.memory_usage(key, samples=0)
+    except redis.ResponseError:
+        # MEMORY USAGE needs redis 4
+        return None
+
+
+def bench_serialization(db, args):
+    boxes = [_random_box_record() for _ in range(args.boxes)]
+    box_ids = [box['_id'] for box in boxes]
+    user_ids = [_random_word(3, 16) for _ in range(1000)]
+    users = [_random_user_record(box_ids, user_ids)
+             for _ in range(args.boxes // 10)]
+
+    for kind, records in (('box', boxes), ('user', users)):
+        for name, (dumps, loads) in SERIALIZATIONS.items():
+            t_encode, encoded = _timed(lambda: [dumps(r) for r in records],
+                                       args.repeat)
+            t_decode, _ = _timed(lambda: [loads(e) for e in encoded],
+                                 args.repeat)
+
+            key = f'benchmark_{kind}_{name}'
+            pipe = db.pipeline(transaction=False)
+
+            for record, data in zip(records, encoded):
+                pipe.hset(key, record['_id'], data)
+
+            pipe.execute()
+
+            size = sum(len(data) for data in encoded) / len(records)
+            memory = _memory_usage(db, key)
+            memory = (f'{memory / len(records):7.1f} B' if memory
+                      else '    n/a  ')
+
+            print(f'{kind:>4} {name:>6}: '
+                  f'encode {len(records) / t_encode:10.0f}/s | '
+                  f'decode {len(records) / t_decode:10.0f}/s | '
+                  f'{size:7.1f} B serialized | redis {memory} per record')
+
+
+def _random_content(vocabulary: list) -> dict:
+    def sentence(low, high):
+        # word frequencies of natural language follow a power law
+        words = random.choices(vocabulary, k=random.randint(low, high),
+                               weights=[1 / (i + 1)
+                                        for i in range(len(vocabulary))])
+        return ' '.join(words).capitalize()
+
+    size = random.randint(5, 200)
+
+    return dict(questions=[sentence(5, 20) + '?' for _ in range(size)],
+                answers=[[sentence(1, 6) for _ in range(3)]
+                         for _ in range(size)],
+                correct_answers=[random.randint(0, 2) for _ in range(size)],
+                explanations=[sentence(0, 30) for _ in range(size)])
+
+
+def bench_content(db, args):
+    vocabulary = [_random_word(2, 10) for _ in range(5000)]
+    number = max(args.boxes // 100, 1)
+    contents = [_random_content(vocabulary) for _ in range(number)]
+
+    # the dictionary is trained on other boxes than the measured ones
+    pipe = db.pipeline(transaction=False)
+    for i in range(number):
+        pipe.hset(TABLE_CONTENT, f'sample{i}', json.dumps(
+            _random_content(vocabulary)))
+    pipe.execute()
+
+    def encode_json(content):
+        return json.dumps(content, sort_keys=True).encode('utf-8')
+
+    def encode_zlib(content):
+        return Card.encode_content(db, content)
+
+    def decode(cards):
+        return Card.decode_content(db, cards)
+
+    variants = [('json', encode_json), ('zlib', encode_zlib),
+                ('zlib+dict', encode_zlib)]
+
+    for name, encode in variants:
+        if name == 'zlib':
+            db.delete(CONTENT_DICT_CURRENT)
+        elif name == 'zlib+dict':
+            Card.train_dictionary(db)
+
+        t_encode, encoded = _timed(lambda: [encode(c) for c in contents],
+                                   args.repeat)
+        t_decode, decoded = _timed(lambda: [decode(e) for e in encoded],
+                                   args.repeat)
+
+        assert decoded == contents
+
+        key = f'benchmark_content_{name}'
+        pipe = db.pipeline(transaction=False)
+
+        for i, cards in enumerate(encoded):
+            pipe.hset(key, i, cards)
+
+        pipe.execute()
+
+        size = sum(len(cards) for cards in encoded) / number
+        memory = _memory_usage(db, key)
+        memory = (f'{memory / number:9.0f} B' if memory else '      n/a  ')
+
+        print(f'{name:>9}: encode {t_encode / number * 1e6:8.1f} us | '
+              f'decode {t_decode / number * 1e6:8.1f} us | '
+              f'{size:9.0f} B stored | redis {memory} per box')
+
+
+BENCHMARKS = {
+    'search': bench_search,
+    'content': bench_content,
+    'serialization': bench_serialization,
+}
+
+
+def main():
+    parser = cli.argument_parser('benchmarks', db=15)
+    parser.add_argument('benchmark', choices=sorted(BENCHMARKS.keys()))
+    parser.add_argument('--boxes', type=int, default=100000)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--force', action='store_true')
+    args = parser.parse_args()
+
+    db = cli.connect(args)
+
+    if db.dbsize() and not args.force:
+        parser.error(f'redis database {args.db} is not empty.')
+
+    try:
+        BENCHMARKS[args.benchmark](db, args)
+    finally:
+        db.flushdb()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,221 @@
+import os
+import copy
+import time
+import threading
+from collections import OrderedDict
+
+import redis
+import flask
+
+import utils
+
+# In-process cache of decoded model records (CardBox, User), shared by the
+#   requests of one worker process.
+# Writes publish '<table> <id>' on the invalidation channel of their redis
+#   database, every worker subscribes to it and drops the record.
+# The TTL bounds staleness should a message get lost; losing the
+#   subscription clears the whole cache.
+# Reads are stamped with the cache version, which every invalidation
+#   increments: a record read before an invalidation never enters the cache.
+# On top of that, every flask request keeps an identity map of the model
+#   objects it read (see fetch_objects).
+
+CHANNEL_PREFIX = 'record-invalidations-'
+MAX_SIZE = 4096
+TTL = 60
+
+
+def _channel(db) -> str:
+    return CHANNEL_PREFIX + str(db.connection_pool.connection_kwargs
+                                .get('db', 0))
+
+
+class RecordCache:
+
+    def __init__(self, max_size=MAX_SIZE, ttl=TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+
+        self.db = None
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+        self._records = OrderedDict()  # (table, id) -> (expiry, record)
+        self._version = 0
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def enable(self, db):
+        """ Caches the records read from 'db'; other connections,
+          e.g. of maintenance scripts, always read from redis.
+        """
+        self.db = db
+
+    def fetch(self, db, table: str, _id: str, read=None):
+        """ Returns a copy of the decoded record, None if there is none. """
+        return self.fetch_multiple(db, table, [_id], read)[0]
+
+    def fetch_multiple(self, db, table: str, ids: list, read=None) -> list:
+        """ Returns copies of the decoded records in the order of 'ids',
+          None for missing records.
+        Misses are read by 'read(db, ids)', by default a single HMGET of
+          serialized records in the 'table' hash.
+        """
+        read = read or (lambda db, ids: read_documents(db, table, ids))
+
+        if db is not self.db:
+            return read(db, ids)
+
+        self._ensure_listener()
+
+        records = [self._get((table, _id)) for _id in ids]
+        missing = [_id for _id, record in zip(ids, records) if record is None]
+
+        if not missing:
+            return records
+
+        stamp = self._version
+        fresh = {_id: record
+                 for _id, record in zip(missing, read(db, missing)) if record}
+
+        for _id, record in fresh.items():
+            self._put((table, _id), record, stamp)
+
+        return [record if record is not None
+                else copy.deepcopy(fresh.get(_id))
+                for _id, record in zip(ids, records)]
+
+    def invalidate(self, db_or_pipe, table: str, _id: str):
+        """ Drops the record here and queues the invalidation message for
+          all workers; call it with the pipeline that writes the record.
+        """
+        self._drop((table, _id))
+
+        identity_map = _identity_map()
+        if identity_map is not None:
+            identity_map.pop((table, _id), None)
+
+        db_or_pipe.publish(_channel(db_or_pipe), f'{table} {_id}')
+
+    def clear(self):
+        with self._lock:
+            self._records.clear()
+            self._version += 1
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+
+        return dict(pid=os.getpid(), size=len(self._records),
+                    max_size=self.max_size, ttl=self.ttl,
+                    hits=self.hits, misses=self.misses,
+                    hit_ratio=self.hits / lookups if lookups else 0.0,
+                    invalidations=self.invalidations)
+
+    def _get(self, key):
+        with self._lock:
+            entry = self._records.get(key)
+
+            if entry and entry[0] > time.monotonic():
+                self._records.move_to_end(key)
+                self.hits += 1
+                return copy.deepcopy(entry[1])
+
+            if entry:
+                del self._records[key]
+
+            self.misses += 1
+            return None
+
+    def _put(self, key, record, stamp: int):
+        with self._lock:
+            if stamp != self._version:
+                return
+
+            self._records[key] = (time.monotonic() + self.ttl, record)
+            self._records.move_to_end(key)
+
+            while len(self._records) > self.max_size:
+                self._records.popitem(last=False)
+
+    def _drop(self, key):
+        with self._lock:
+            self._records.pop(key, None)
+            self._version += 1
+            self.invalidations += 1
+
+    def _ensure_listener(self):
+        # started lazily, so every forked worker gets its own subscriber
+        if self._pid == os.getpid():
+            return
+
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+
+            self._pid = os.getpid()
+            self._records.clear()
+            self._version += 1
+
+        threading.Thread(target=self._listen, args=(self.db,),
+                         daemon=True).start()
+
+    def _listen(self, db):
+        while True:
+            try:
+                pubsub = db.pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(_channel(db))
+                # records read before subscribing may have missed messages
+                self.clear()
+
+                for message in pubsub.listen():
+                    data = message['data'].decode('utf-8')
+                    table, _, _id = data.partition(' ')
+                    self._drop((table, _id))
+
+            except redis.ConnectionError:
+                pass
+
+            self.clear()
+            time.sleep(1)
+
+
+records = RecordCache()
+
+
+def read_documents(db, table: str, ids: list) -> list:
+    return [utils.decode_record(document) if document else None
+            for document in db.hmget(table, *ids)]
+
+
+def fetch_objects(db, table: str, ids: list, factory, read=None) -> list:
+    """ Returns the model objects built by 'factory' from the records of
+      'ids' in that order, None for missing records; see
+      RecordCache.fetch_multiple for 'read'.
+    Within a request every record is read at most once and repeated fetches
+      return the very same object, until a write invalidates it.
+    """
+    identity_map = _identity_map() if db is records.db else None
+
+    if identity_map is None:
+        return [factory(**record) if record else None
+                for record in records.fetch_multiple(db, table, ids, read)]
+
+    missing = [_id for _id in ids if (table, _id) not in identity_map]
+
+    if missing:
+        for _id, record in zip(missing, records.fetch_multiple(db, table,
+                                                               missing, read)):
+            identity_map[(table, _id)] = factory(**record) if record else None
+
+    return [identity_map[(table, _id)] for _id in ids]
+
+
+def _identity_map():
+    if not flask.has_request_context():
+        return None
+
+    if 'identity_map' not in flask.g:
+        flask.g.identity_map = {}
+
+    return flask.g.identity_map
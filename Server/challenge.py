@@ -11,19 +11,53 @@ from model import CardBox, Card
 DUEL_SUFFIX = '_duels'
 CHALLENGE_SUFFIX = '_challenges'
 ARCHIVE_SUFFIX = '_archive'
+COUNTER_SUFFIX = '_vs_counters'
 TABLE_VS = 'vs-info'
+# duel id -> compact header of the duel, used by list views
+TABLE_VS_HEADERS = 'vs-headers'
+# content hash -> box content, shared by all duels played with that content
+TABLE_SNAPSHOTS = 'vs-snapshots'
+# content hash -> number of duels referencing the snapshot
+TABLE_SNAPSHOT_REFS = 'vs-snapshot-refs'
+# sweep name -> scan cursor of the running sweep, see duel_sweeper.py
+TABLE_SWEEP_CURSORS = 'vs-sweep-cursors'
+
+# unstarted challenges older than this (in seconds) are deleted by sweeps
+CHALLENGE_MAX_AGE = 14 * 24 * 60 * 60
+# length of the ids made by gen_duel_id()
+DUEL_ID_LENGTH = 24
+
+# fields of the per-user counter hash
+INCOMING = 'incoming'
+OUTGOING = 'outgoing'
 
 DRAW = 'd'
 
+HEADER_FIELDS = ('duel_id', 'challenger', 'challenged', 'box_id', 'box_name',
+                 'started', 'winner', 'finish_time', 'scores')
+
 """
 Design of challenge-dict:
 'challenger': user-id of challenging user
 'challenged': user-id of challenged user
 'box_id': box-id of CardBox used for challenge
 'box_name': box name of CardBox used for challenge
-'box_content': content of CardBox used for challenge at time of challenge issue
+'content_ref': hash of the content snapshot (TABLE_SNAPSHOTS) of the CardBox
+               at time of challenge issue
+'box_size': number of cards in the content snapshot
+'correct_answers': correct answers of the content snapshot
+'issued': time of challenge issue, set by the first sweep for old duels
 'started': Bool, True if challenge is accepted; running or finished
 'winner': user-id of winner if finished, else emptystring
+'scores': [challenger, challenged] number of correct answers, once finished
+'summary': final answers of a finished duel, see result_summary()
+
+Every duel also has a header in TABLE_VS_HEADERS that only holds the fields
+in HEADER_FIELDS. List views read headers only.
+
+Duels issued before content snapshots existed carry the whole content as
+'box_content' instead of 'content_ref', 'box_size' and 'correct_answers'.
+load_content() attaches 'box_content' for both kinds of duels.
 """
 
 
@@ -34,22 +68,33 @@ def gen_duel_id():
 def challenge(db, challenger_id, challenged_id, box_id):
     new_duel_id = gen_duel_id()
 
-    box = CardBox.fetch(db, box_id)
-    content = Card.fetch_content(db, box_id)
+    box, content = CardBox.fetch_with_content(db, box_id)
+
+    content_json = json.dumps(content, sort_keys=True)
+    content_ref = utils.sha1_of(content_json)
 
     vs_dict = dict(duel_id=new_duel_id,
                    challenger=challenger_id,
                    challenged=challenged_id,
                    box_id=box_id,
                    box_name=box.name,
-                   box_content=content,
+                   content_ref=content_ref,
+                   box_size=len(content['questions']),
+                   correct_answers=content['correct_answers'],
+                   issued=utils.unix_time_in_seconds(),
                    started=False,
                    finish_time=None,
                    winner='')
 
-    db.hset(TABLE_VS, new_duel_id, json.dumps(vs_dict))
-    db.rpush(challenger_id + CHALLENGE_SUFFIX, new_duel_id)
-    db.rpush(challenged_id + CHALLENGE_SUFFIX, new_duel_id)
+    _acquire_snapshot(db, content_ref, content)
+
+    pipe = db.pipeline()
+    _queue_store_duel(pipe, vs_dict)
+    pipe.rpush(challenger_id + CHALLENGE_SUFFIX, new_duel_id)
+    pipe.rpush(challenged_id + CHALLENGE_SUFFIX, new_duel_id)
+    pipe.hincrby(challenger_id + COUNTER_SUFFIX, OUTGOING, 1)
+    pipe.hincrby(challenged_id + COUNTER_SUFFIX, INCOMING, 1)
+    pipe.execute()
 
     return new_duel_id
 
@@ -66,6 +111,85 @@ def fetch_duel(db, duel_id: str):
     return utils.unjsonify(json_string)
 
 
+def load_content(db, duel: dict) -> dict:
+    """ Attaches the content snapshot of the duel as 'box_content'. """
+    if 'box_content' not in duel:
+        cards = db.hget(TABLE_SNAPSHOTS, duel['content_ref'])
+        duel['box_content'] = Card.decode_content(db, cards)
+
+    return duel['box_content']
+
+
+def _acquire_snapshot(db, content_ref: str, content: dict):
+    """ Counts a reference to the snapshot and stores it if missing.
+    The reference comes first, so a concurrent release cannot remove the
+      snapshot once it was found; content is only encoded on a miss.
+    """
+    pipe = db.pipeline()
+    pipe.hincrby(TABLE_SNAPSHOT_REFS, content_ref, 1)
+    pipe.hexists(TABLE_SNAPSHOTS, content_ref)
+    _, exists = pipe.execute()
+
+    if not exists:
+        db.hsetnx(TABLE_SNAPSHOTS, content_ref,
+                  Card.encode_content(db, content))
+
+
+def _queue_release_content(pipe, duel: dict):
+    if 'content_ref' in duel:
+        _RELEASE_SNAPSHOT_SCRIPT(pipe, keys=[TABLE_SNAPSHOT_REFS,
+                                             TABLE_SNAPSHOTS],
+                                 args=[duel['content_ref']])
+
+
+# KEYS: TABLE_SNAPSHOT_REFS, TABLE_SNAPSHOTS
+# ARGV: content hash
+_RELEASE_SNAPSHOT_SCRIPT = utils.LuaScript("""
+if redis.call('HINCRBY', KEYS[1], ARGV[1], -1) <= 0 then
+    redis.call('HDEL', KEYS[1], ARGV[1])
+    redis.call('HDEL', KEYS[2], ARGV[1])
+end
+""")
+
+
+def fetch_multiple_headers(db, duel_ids: list) -> list:
+    """ Returns the headers (see HEADER_FIELDS) of the given duels.
+    Missing headers of old duels are created from the full duel record.
+    """
+    if not duel_ids:
+        return []
+
+    json_strings = db.hmget(TABLE_VS_HEADERS, *duel_ids)
+
+    missing = [duel_id for duel_id, json_string in zip(duel_ids, json_strings)
+               if not json_string]
+    backfill = {duel['duel_id']: duel
+                for duel in fetch_multiple_duels(db, missing)}
+
+    headers = []
+
+    for duel_id, json_string in zip(duel_ids, json_strings):
+        if json_string:
+            headers.append(utils.unjsonify(json_string))
+        elif duel_id in backfill:
+            header = _header_of(backfill[duel_id])
+            # a concurrent transition may have written a newer header
+            db.hsetnx(TABLE_VS_HEADERS, duel_id, json.dumps(header))
+            headers.append(header)
+
+    return headers
+
+
+def _header_of(duel: dict) -> dict:
+    return {field: duel.get(field) for field in HEADER_FIELDS}
+
+
+def _queue_store_duel(pipe, duel: dict):
+    pipe.hset(TABLE_VS, duel['duel_id'], json.dumps(duel))
+    pipe.hset(TABLE_VS_HEADERS, duel['duel_id'],
+              json.dumps(_header_of(duel)))
+
+
 def fetch_multiple_duels(db, duel_ids: list):
     if not duel_ids:
         return []
@@ -76,91 +200,171 @@ def fetch_multiple_duels(db, duel_ids: list):
         return []
 
     return [utils.unjsonify(json_string)
-            for json_string in json_strings]
+            for json_string in json_strings if json_string]
+
+
+# Duel transitions are scripts, so they neither race each other nor
+#   conflict with transitions of unrelated duels.
+# Scripts on challenges share their first KEYS and ARGV, see _challenge_keys
+#   and _challenge_args:
+# KEYS: TABLE_VS, TABLE_VS_HEADERS, challenge lists of challenger and
+#   challenged, counter hashes of challenger and challenged
+# ARGV: duel id, counter field of incoming and of outgoing challenges
+_LUA_READ_CHALLENGE = """
+local json_string = redis.call('HGET', KEYS[1], ARGV[1])
+if not json_string then
+    return 0
+end
+local duel = cjson.decode(json_string)
+if duel['started'] then
+    return 0
+end
+"""
 
+_LUA_REMOVE_CHALLENGE = """
+redis.call('LREM', KEYS[3], 0, ARGV[1])
+redis.call('LREM', KEYS[4], 0, ARGV[1])
+redis.call('HINCRBY', KEYS[5], ARGV[3], -1)
+redis.call('HINCRBY', KEYS[6], ARGV[2], -1)
+"""
 
-def _remove_challenge(db, duel_id):
-    duel = fetch_duel(db, duel_id)
 
-    if not duel:
-        return
+def _challenge_keys(duel: dict) -> list:
+    return [TABLE_VS, TABLE_VS_HEADERS,
+            duel['challenger'] + CHALLENGE_SUFFIX,
+            duel['challenged'] + CHALLENGE_SUFFIX,
+            duel['challenger'] + COUNTER_SUFFIX,
+            duel['challenged'] + COUNTER_SUFFIX]
 
-    db.lrem(duel['challenger'] + CHALLENGE_SUFFIX, 0, duel_id)
-    db.lrem(duel['challenged'] + CHALLENGE_SUFFIX, 0, duel_id)
 
-    return True
+def _challenge_args(duel_id: str) -> list:
+    return [duel_id, INCOMING, OUTGOING]
 
 
-def delete_challenge(db, duel_id):
+def delete_challenge(db, duel_id, issued_before=None) -> bool:
+    """ Deletes the challenge unless it was accepted meanwhile; with
+      'issued_before', only if it was issued before that time.
+    """
     duel = fetch_duel(db, duel_id)
 
     if not duel:
-        return
+        return False
 
-    _remove_challenge(db, duel_id)
+    keys = _challenge_keys(duel) + [TABLE_SNAPSHOT_REFS, TABLE_SNAPSHOTS]
+    args = _challenge_args(duel_id) + [issued_before or '']
 
-    db.hdel(TABLE_VS, duel_id)
+    return bool(_DELETE_CHALLENGE_SCRIPT(db, keys=keys, args=args))
 
-    return True
+
+# KEYS: see _LUA_READ_CHALLENGE, TABLE_SNAPSHOT_REFS, TABLE_SNAPSHOTS
+# ARGV: see _LUA_READ_CHALLENGE, issue time limit or empty string
+_DELETE_CHALLENGE_SCRIPT = utils.LuaScript(_LUA_READ_CHALLENGE + """
+if ARGV[4] ~= '' and (not duel['issued'] or
+                      duel['issued'] >= tonumber(ARGV[4])) then
+    return 0
+end
+""" + _LUA_REMOVE_CHALLENGE + """
+local ref = duel['content_ref']
+if ref and redis.call('HINCRBY', KEYS[7], ref, -1) <= 0 then
+    redis.call('HDEL', KEYS[7], ref)
+    redis.call('HDEL', KEYS[8], ref)
+end
+redis.call('HDEL', KEYS[1], ARGV[1])
+redis.call('HDEL', KEYS[2], ARGV[1])
+return 1
+""")
 
 
 def fetch_challenges_of(db, user_id) -> list:
     all_ids = _list_items_of_key(db, user_id + CHALLENGE_SUFFIX)
-    all_duels = fetch_multiple_duels(db, all_ids)
+    all_duels = fetch_multiple_headers(db, all_ids)
     return [duel for duel in all_duels
             if duel['challenger'] == user_id]
 
 
 def fetch_challenges_to(db, user_id) -> list:
     all_ids = _list_items_of_key(db, user_id + CHALLENGE_SUFFIX)
-    all_duels = fetch_multiple_duels(db, all_ids)
+    all_duels = fetch_multiple_headers(db, all_ids)
     return [duel for duel in all_duels
             if duel['challenged'] == user_id]
 
 
-def start_duel(db, duel_id):
+def start_duel(db, duel_id) -> bool:
     duel = fetch_duel(db, duel_id)
 
-    if duel['started']:
-        return
+    if not duel:
+        return False
+
+    keys = _challenge_keys(duel) + [duel['challenger'] + DUEL_SUFFIX,
+                                    duel['challenged'] + DUEL_SUFFIX]
+    args = _challenge_args(duel_id) + list(HEADER_FIELDS)
 
-    _remove_challenge(db, duel_id)
+    return bool(_START_DUEL_SCRIPT(db, keys=keys, args=args))
 
-    duel['started'] = True
-    _store_duel(db, duel_id, duel)
 
-    db.rpush(duel['challenger'] + DUEL_SUFFIX, duel_id)
-    db.rpush(duel['challenged'] + DUEL_SUFFIX, duel_id)
+# KEYS: see _LUA_READ_CHALLENGE, duel lists of challenger and challenged
+# ARGV: see _LUA_READ_CHALLENGE, header fields
+_START_DUEL_SCRIPT = utils.LuaScript(_LUA_READ_CHALLENGE +
+                                     _LUA_REMOVE_CHALLENGE + """
+duel['started'] = true
+redis.call('HSET', KEYS[1], ARGV[1], cjson.encode(duel))
 
-    return True
+local header = {}
+for i = 4, #ARGV do
+    header[ARGV[i]] = duel[ARGV[i]]
+end
+redis.call('HSET', KEYS[2], ARGV[1], cjson.encode(header))
+
+redis.call('RPUSH', KEYS[7], ARGV[1])
+redis.call('RPUSH', KEYS[8], ARGV[1])
+return 1
+""")
 
 
 def fetch_duels_of(db, user_id) -> list:
     all_ids = _list_items_of_key(db, user_id + DUEL_SUFFIX)
-    return fetch_multiple_duels(db, all_ids)
+    return fetch_multiple_headers(db, all_ids)
+
 
+def archive_source(db, user_id):
+    """ Archived duels of a user, newest first, fetched lazily. """
+    def loader(duel_ids):
+        return fetch_multiple_headers(db, duel_ids)
 
-def fetch_archived_duels(db, user_id) -> list:
-    all_ids = _list_items_of_key(db, user_id + ARCHIVE_SUFFIX, reverse=True)
-    return fetch_multiple_duels(db, all_ids)
+    return utils.RedisListSource(db, user_id + ARCHIVE_SUFFIX, reverse=True,
+                                 loader=loader)
 
 
-def archive_duel(db, duel_id):
+def archive_duel(db, duel_id) -> bool:
     duel = fetch_duel(db, duel_id)
 
     if not duel:
-        return
+        return False
 
-    db.lrem(duel['challenger'] + DUEL_SUFFIX, 0, duel_id)
-    db.lrem(duel['challenged'] + DUEL_SUFFIX, 0, duel_id)
+    keys = [TABLE_VS,
+            duel['challenger'] + DUEL_SUFFIX, duel['challenged'] + DUEL_SUFFIX,
+            duel['challenger'] + ARCHIVE_SUFFIX,
+            duel['challenged'] + ARCHIVE_SUFFIX]
 
-    db.rpush(duel['challenger'] + ARCHIVE_SUFFIX, duel_id)
-    db.rpush(duel['challenged'] + ARCHIVE_SUFFIX, duel_id)
+    return bool(_ARCHIVE_DUEL_SCRIPT(db, keys=keys, args=[duel_id]))
 
-    return True
+
+# KEYS: TABLE_VS, duel lists of challenger and challenged, archives of both
+# ARGV: duel id
+_ARCHIVE_DUEL_SCRIPT = utils.LuaScript("""
+if redis.call('HEXISTS', KEYS[1], ARGV[1]) == 0 then
+    return 0
+end
+for i = 2, 3 do
+    redis.call('LREM', KEYS[i], 0, ARGV[1])
+    redis.call('RPUSH', KEYS[i + 2], ARGV[1])
+end
+return 1
+""")
 
 
 def get_card_from_duel(duel: dict, index: int) -> dict:
+    """ Needs the content attached by load_content(). """
     cards = duel['box_content']
 
     if not cards:
@@ -175,49 +379,174 @@ def get_card_from_duel(duel: dict, index: int) -> dict:
     return card
 
 
+def _answer_key(duel_id: str, user_id: str) -> str:
+    return duel_id + '_' + user_id
+
+
 def answers_of(db, user_id: str, duel_id: str) -> list:
-    answers = db.lrange(duel_id + '_' + user_id, 0, -1)
+    """ Answers of a running duel; see answers_in() for finished ones. """
+    answers = db.lrange(_answer_key(duel_id, user_id), 0, -1)
 
     return [int(x.decode('utf-8'))
             for x in answers]
 
 
-def put_answer(db, user_id: str, duel_id: str, answer: int):
-    """ 'answer' should be in [0, 1, 2]."""
-    db.rpush(duel_id + '_' + user_id, answer)
+def answers_in(db, duel: dict, user_id: str) -> list:
+    """ Answers of 'user_id', read from the summary of finished duels. """
+    if 'summary' not in duel:
+        return answers_of(db, user_id, duel['duel_id'])
 
+    player = int(user_id == duel['challenged'])
 
-def finish_duel(db, duel_id: str) -> str:
-    duel = fetch_duel(db, duel_id)
+    return [int(x) for x in duel['summary']['answers'][player]]
 
-    if not duel:
-        return
 
+def result_summary(db, duel: dict) -> dict:
+    """ Answers, correctness and number of correct answers of both players
+      in a finished duel, keyed like the variables of duel_result.html.
+    Duels finished before summaries existed are evaluated from their
+      answer lists.
+    """
+    if 'summary' in duel:
+        answers = [[int(x) for x in answers]
+                   for answers in duel['summary']['answers']]
+        checks = [[x == '1' for x in bits]
+                  for bits in duel['summary']['correct']]
+        scores = duel['scores']
+    else:
+        correct = correct_answers_of(duel)
+        answers = [answers_of(db, duel[player], duel['duel_id'])
+                   for player in ('challenger', 'challenged')]
+        checks = [check_answer_list(correct, player_answers)
+                  for player_answers in answers]
+        scores = [sum(player_checks) for player_checks in checks]
+
+    return dict(answers_challenger=answers[0],
+                answers_challenged=answers[1],
+                bool_challenger=checks[0],
+                bool_challenged=checks[1],
+                num_correct_challenger=scores[0],
+                num_correct_challenged=scores[1])
+
+
+def submit_answer(db, duel: dict, user_id: str, answer=None) -> dict:
+    """ Appends 'answer' of 'user_id' and finishes the duel if both players
+    answered every card, all in one atomic script call.
+    Finishing stores the scores and a summary of the answers in the duel
+      record and deletes the answer lists of both players.
+    The answer is dropped if the user already answered every card or if the
+      duel is not running. Without an answer, the duel is only finished.
+    Returns the new state: dict(num_answers, num_answers_opponent, winner).
+    """
+    duel_id = duel['duel_id']
     challenger_id = duel['challenger']
     challenged_id = duel['challenged']
+    opponent_id = get_opponent(duel, user_id)
 
-    answers_challenger = answers_of(db, challenger_id, duel_id)
-    answers_challenged = answers_of(db, challenged_id, duel_id)
-
-    list_truth = duel['box_content']['correct_answers']
-
-    score_challenger = num_correct_answers(list_truth, answers_challenger)
-    score_challenged = num_correct_answers(list_truth, answers_challenged)
+    keys = [TABLE_VS, TABLE_VS_HEADERS,
+            _answer_key(duel_id, user_id),
+            _answer_key(duel_id, opponent_id),
+            challenger_id + DUEL_SUFFIX, challenged_id + DUEL_SUFFIX,
+            challenger_id + ARCHIVE_SUFFIX, challenged_id + ARCHIVE_SUFFIX]
 
-    if score_challenger == score_challenged:
-        winner = DRAW
-    else:
-        winner = (challenger_id if score_challenger > score_challenged
-                  else challenged_id)
-
-    duel['winner'] = winner
-    duel['finish_time'] = utils.unix_time_in_seconds()
+    args = [duel_id, '' if answer is None else answer,
+            int(user_id == challenger_id),
+            utils.unix_time_in_seconds(), DRAW, *HEADER_FIELDS]
 
-    _store_duel(db, duel_id, duel)
+    result = _SUBMIT_ANSWER_SCRIPT(db, keys=keys, args=args)
 
-    archive_duel(db, duel_id)
+    if not result:
+        return None
 
-    return winner
+    num_answers, num_answers_opponent, winner = result
+
+    return dict(num_answers=num_answers,
+                num_answers_opponent=num_answers_opponent,
+                winner=winner.decode('utf-8'))
+
+
+# KEYS: TABLE_VS, TABLE_VS_HEADERS, answers of user, answers of opponent,
+#   duel lists of challenger and challenged, archives of both
+# ARGV: duel id, answer or empty string, 1 if user is the challenger else 0,
+#   finish time, draw marker, header fields
+_SUBMIT_ANSWER_SCRIPT = utils.LuaScript("""
+local json_string = redis.call('HGET', KEYS[1], ARGV[1])
+if not json_string then
+    return false
+end
+
+local duel = cjson.decode(json_string)
+local truth = duel['correct_answers']
+if not truth then
+    truth = duel['box_content']['correct_answers']
+end
+local running = duel['started'] == true and duel['winner'] == ''
+
+if running and ARGV[2] ~= '' and redis.call('LLEN', KEYS[3]) < #truth then
+    redis.call('RPUSH', KEYS[3], ARGV[2])
+end
+
+local answers = redis.call('LRANGE', KEYS[3], 0, -1)
+local answers_opponent = redis.call('LRANGE', KEYS[4], 0, -1)
+
+if running and #answers == #truth and #answers_opponent == #truth then
+    local score, score_opponent = 0, 0
+    local bits, bits_opponent = {}, {}
+    for i, correct in ipairs(truth) do
+        bits[i], bits_opponent[i] = '0', '0'
+        if tonumber(answers[i]) == correct then
+            score = score + 1
+            bits[i] = '1'
+        end
+        if tonumber(answers_opponent[i]) == correct then
+            score_opponent = score_opponent + 1
+            bits_opponent[i] = '1'
+        end
+    end
+
+    -- answers and bitmaps as strings, one digit per card
+    local user, opponent = duel['challenger'], duel['challenged']
+    local scores = {score, score_opponent}
+    local summary = {answers = {table.concat(answers),
+                                table.concat(answers_opponent)},
+                     correct = {table.concat(bits),
+                                table.concat(bits_opponent)}}
+    if ARGV[3] == '0' then
+        user, opponent = opponent, user
+        scores = {score_opponent, score}
+        summary['answers'] = {summary['answers'][2], summary['answers'][1]}
+        summary['correct'] = {summary['correct'][2], summary['correct'][1]}
+    end
+    duel['scores'] = scores
+    duel['summary'] = summary
+
+    if score == score_opponent then
+        duel['winner'] = ARGV[5]
+    elseif score > score_opponent then
+        duel['winner'] = user
+    else
+        duel['winner'] = opponent
+    end
+    duel['finish_time'] = tonumber(ARGV[4])
+
+    redis.call('HSET', KEYS[1], ARGV[1], cjson.encode(duel))
+
+    local header = {}
+    for i = 6, #ARGV do
+        header[ARGV[i]] = duel[ARGV[i]]
+    end
+    redis.call('HSET', KEYS[2], ARGV[1], cjson.encode(header))
+
+    for i = 5, 6 do
+        redis.call('LREM', KEYS[i], 0, ARGV[1])
+        redis.call('RPUSH', KEYS[i + 2], ARGV[1])
+    end
+
+    redis.call('DEL', KEYS[3], KEYS[4])
+end
+
+return {#answers, #answers_opponent, duel['winner']}
+""")
 
 
 def get_opponent(duel: dict, user_id: str) -> str:
@@ -225,14 +554,20 @@ def get_opponent(duel: dict, user_id: str) -> str:
     return d['challenger'] if user_id == d['challenged'] else d['challenged']
 
 
-def num_answers_of(db, user_id: str, duel_id: str) -> int:
-    return db.llen(duel_id + '_' + user_id)
-
-
 def duel_length(duel: dict) -> int:
+    if 'box_size' in duel:
+        return duel['box_size']
+
     return len(duel['box_content']['questions'])
 
 
+def correct_answers_of(duel: dict) -> list:
+    if 'correct_answers' in duel:
+        return duel['correct_answers']
+
+    return duel['box_content']['correct_answers']
+
+
 def num_correct_answers(list_truth: list, list_answers: list):
     if not len(list_truth) == len(list_answers):
         raise ValueError()
@@ -257,24 +592,226 @@ def check_answer_list(list_truth: list, list_answers: list):
 
 
 def num_incoming_challenges(db, user_id: str) -> int:
-    # TODO: redis counter, maybe?
-    return len(fetch_challenges_to(db, user_id))
+    return _counter_value(db.hget(user_id + COUNTER_SUFFIX, INCOMING))
 
 
 def num_outgoing_challenges(db, user_id: str) -> int:
-    # TODO: redis counter, maybe?
-    return len(fetch_challenges_of(db, user_id))
+    return _counter_value(db.hget(user_id + COUNTER_SUFFIX, OUTGOING))
 
 
 def num_duels(db, user_id: str) -> int:
     return db.llen(user_id + DUEL_SUFFIX)
 
 
-def _store_duel(db, duel_id: str, duel: dict):
-    if not duel:
-        return
+def notification_counts(db, user_id: str) -> dict:
+    """ Incoming/outgoing challenges and running duels in one round trip.
+    """
+    pipe = db.pipeline(transaction=False)
+    pipe.hmget(user_id + COUNTER_SUFFIX, INCOMING, OUTGOING)
+    pipe.llen(user_id + DUEL_SUFFIX)
+    (incoming, outgoing), duels = pipe.execute()
+
+    return dict(incoming=_counter_value(incoming),
+                outgoing=_counter_value(outgoing),
+                duels=duels)
+
+
+def rebuild_counters(db, user_id: str):
+    """ Recounts the challenges of a user from the challenge list. """
+    db.hset(user_id + COUNTER_SUFFIX,
+            mapping={INCOMING: len(fetch_challenges_to(db, user_id)),
+                     OUTGOING: len(fetch_challenges_of(db, user_id))})
+
+
+def _counter_value(value) -> int:
+    return max(int(value or 0), 0)
+
+
+def migrate_to_snapshot(db, duel_id: str) -> bool:
+    """ Moves the inline 'box_content' of an old duel into a snapshot. """
+    json_string = db.hget(TABLE_VS, duel_id)
+    duel = utils.unjsonify(json_string) if json_string else None
+
+    if not duel or 'box_content' not in duel:
+        return False
+
+    content = duel.pop('box_content')
+    content_json = json.dumps(content, sort_keys=True)
+
+    duel['content_ref'] = utils.sha1_of(content_json)
+    duel['box_size'] = len(content['questions'])
+    duel['correct_answers'] = content['correct_answers']
+
+    _acquire_snapshot(db, duel['content_ref'], content)
+
+    pipe = db.pipeline()
+    _queue_replace_duel(pipe, json_string, duel)
+
+    if pipe.execute()[0]:
+        return True
+
+    # the duel changed meanwhile, give back the reference
+    pipe = db.pipeline()
+    _queue_release_content(pipe, duel)
+    pipe.execute()
+
+    return False
+
+
+def _queue_replace_duel(pipe, json_string: bytes, duel: dict):
+    """ Stores the duel only if its record still is 'json_string'; the
+      header is left alone.
+    """
+    utils.REPLACE_FIELD_SCRIPT(pipe, keys=[TABLE_VS],
+                               args=[duel['duel_id'], json_string,
+                                     json.dumps(duel)])
+
+
+def compact_duel(db, duel_id: str) -> bool:
+    """ Folds the answer lists of a duel finished before result summaries
+      existed into its record, like submit_answer does on finish.
+    """
+    json_string = db.hget(TABLE_VS, duel_id)
+    duel = utils.unjsonify(json_string) if json_string else None
+
+    if not duel or not duel['winner'] or 'summary' in duel:
+        return False
+
+    result = result_summary(db, duel)
+    players = ('challenger', 'challenged')
+
+    duel['scores'] = [result['num_correct_' + p] for p in players]
+    duel['summary'] = dict(
+        answers=[''.join(str(x) for x in result['answers_' + p])
+                 for p in players],
+        correct=[''.join('1' if x else '0' for x in result['bool_' + p])
+                 for p in players])
+
+    pipe = db.pipeline()
+    _queue_replace_duel(pipe, json_string, duel)
+
+    # the record changed meanwhile, e.g. by migrate_to_snapshot; the answer
+    #   lists stay for the next sweep
+    if not pipe.execute()[0]:
+        return False
+
+    pipe = db.pipeline()
+    pipe.hset(TABLE_VS_HEADERS, duel_id, json.dumps(_header_of(duel)))
+    pipe.delete(*[_answer_key(duel_id, duel[p]) for p in players])
+    pipe.execute()
+
+    return True
+
+
+def expire_challenge(db, duel_id: str, now: int, max_age: int):
+    """ Deletes the challenge if it was issued more than 'max_age' seconds
+      before 'now' and still is not accepted. Challenges without issue time
+      get 'now', so they expire 'max_age' after the first sweep.
+    Returns 'expired', 'stamped' or None if nothing changed.
+    """
+    json_string = db.hget(TABLE_VS, duel_id)
+    duel = utils.unjsonify(json_string) if json_string else None
+
+    if not duel or duel['started']:
+        return None
+
+    if 'issued' not in duel:
+        duel['issued'] = now
+        pipe = db.pipeline()
+        _queue_replace_duel(pipe, json_string, duel)
+
+        return 'stamped' if pipe.execute()[0] else None
+
+    if delete_challenge(db, duel_id, issued_before=now - max_age):
+        return 'expired'
+
+    return None
+
+
+def sweep_duels(db, cursor=0, max_age=CHALLENGE_MAX_AGE, batch_size=100):
+    """ Visits one HSCAN batch of duel records: expires abandoned
+      challenges and compacts finished duels that still have answer lists.
+    Returns the next cursor, 0 after the last batch, and the counts of
+      scanned, expired, stamped and compacted duels.
+    """
+    now = utils.unix_time_in_seconds()
+    counts = dict(scanned=0, expired=0, stamped=0, compacted=0)
+
+    cursor, batch = db.hscan(TABLE_VS, cursor, count=batch_size)
+
+    for duel_id, json_string in batch.items():
+        duel_id = duel_id.decode('utf-8')
+        duel = utils.unjsonify(json_string)
+        counts['scanned'] += 1
+
+        if not duel['started']:
+            issued = duel.get('issued')
+
+            if issued is None or now - issued > max_age:
+                state = expire_challenge(db, duel_id, now, max_age)
+
+                if state:
+                    counts[state] += 1
+
+        elif duel['winner'] and 'summary' not in duel:
+            if compact_duel(db, duel_id):
+                counts['compacted'] += 1
+
+    return cursor, counts
+
+
+def sweep_answer_lists(db, cursor=0, batch_size=100):
+    """ Visits one SCAN batch of the keyspace and deletes the answer lists
+      of finished or deleted duels; lists of legacy finished duels are
+      compacted first.
+    Returns the next cursor, 0 after the last batch, and the counts of
+      scanned keys, removed answer lists and compacted duels.
+    """
+    cursor, keys = db.scan(cursor, match='*==_*', count=batch_size)
+    counts = dict(scanned=len(keys), removed=0, compacted=0)
+
+    # answer list keys are '<duel_id>_<user_id>', duel ids end with '=='
+    candidates = [key.decode('utf-8') for key in keys
+                  if key.find(b'==_') == DUEL_ID_LENGTH - 2]
+
+    if not candidates:
+        return cursor, counts
+
+    pipe = db.pipeline(transaction=False)
+    for key in candidates:
+        pipe.type(key)
+    types = pipe.execute()
+
+    candidates = [key for key, _type in zip(candidates, types)
+                  if _type == b'list']
+
+    if not candidates:
+        return cursor, counts
+
+    duel_ids = [key[:DUEL_ID_LENGTH] for key in candidates]
+    json_strings = db.hmget(TABLE_VS, *duel_ids)
+    orphans = []
+
+    for key, duel_id, json_string in zip(candidates, duel_ids, json_strings):
+        if not json_string:
+            orphans.append(key)
+            continue
+
+        duel = utils.unjsonify(json_string)
+        user_id = key[DUEL_ID_LENGTH + 1:]
+
+        if user_id not in (duel['challenger'], duel['challenged']):
+            continue
+
+        if 'summary' in duel:
+            orphans.append(key)
+        elif duel['winner'] and compact_duel(db, duel_id):
+            counts['compacted'] += 1
+
+    if orphans:
+        counts['removed'] += db.delete(*orphans)
 
-    db.hset(TABLE_VS, duel_id, json.dumps(duel))
+    return cursor, counts
 
 
 def _list_items_of_key(db, key: str, reverse=False) -> list:
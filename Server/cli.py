@@ -0,0 +1,60 @@
+import time
+import argparse
+from collections import Counter
+
+import redis
+
+# Shared parts of the command line scripts (maintenance.py, benchmark.py,
+#   score_worker.py, duel_sweeper.py, integrity_scanner.py).
+
+
+def argument_parser(description: str, db=0):
+    """ Parser with the connection options of every script. """
+    parser = argparse.ArgumentParser(description='FlashBoxFactory ' +
+                                                 description)
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=6379)
+    parser.add_argument('--db', type=int, default=db)
+    return parser
+
+
+def add_batch_arguments(parser):
+    """ Options of scripts that run resumable batches (run_batches). """
+    parser.add_argument('--batch', type=int, default=100)
+    parser.add_argument('--pause', type=float, default=0.1,
+                        help='seconds between two batches')
+
+
+def connect(args):
+    return redis.StrictRedis(host=args.host, port=args.port, db=args.db)
+
+
+def format_counts(counts: dict) -> str:
+    return ', '.join(f'{key} {value}' for key, value in counts.items())
+
+
+def run_batches(db, steps: dict, cursor_table: str, pause: float):
+    """ Runs every step to the end of the keyspace once and reports the
+      progress after each batch.
+    'steps' maps names to functions 'step(db, cursor)' that handle one
+      SCAN batch and return the next cursor, 0 after the last batch, and a
+      dict of counts. The cursors are kept in the 'cursor_table' hash, so an
+      interrupted run resumes where it stopped.
+    """
+    for name, step in steps.items():
+        cursor = int(db.hget(cursor_table, name) or 0)
+        totals = Counter()
+
+        while True:
+            cursor, counts = step(db, cursor)
+            db.hset(cursor_table, name, cursor)
+            totals.update(counts)
+
+            print(f'{name}: {format_counts(counts)} (cursor {cursor})')
+
+            if not cursor:
+                break
+
+            time.sleep(pause)
+
+        print(f'{name} finished: {format_counts(totals)}')
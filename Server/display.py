@@ -26,7 +26,9 @@ class CardBoxTable(Table):
     def sort_url(self, col_key, reverse=False):
         direction = 'desc' if reverse else 'asc'
 
-        kwargs = {key: value for key, value in request.args.items()}
+        # a new order needs a new snapshot of the filter results
+        kwargs = {key: value for key, value in request.args.items()
+                  if key != 'snap'}
         kwargs.update(direction=direction, sort=col_key)
 
         return url_for('huge_list', **kwargs)
@@ -59,7 +61,9 @@ class ChooseBoxTable(Table):
     def sort_url(self, col_key, reverse=False):
         direction = 'desc' if reverse else 'asc'
 
-        kwargs = {key: value for key, value in request.args.items()}
+        # a new order needs a new snapshot of the filter results
+        kwargs = {key: value for key, value in request.args.items()
+                  if key != 'snap'}
         kwargs.update(direction=direction, sort=col_key)
 
         return url_for('challenge_user', _id=self.partner_id, **kwargs)
@@ -147,6 +151,7 @@ class DuelArchiveTable(Table):
     box_name = LinkCol('Box', endpoint='show_box',
                        url_kwargs=dict(_id='box_id'),
                        attr_list='box_name')
+    score = Col('Score')
     results = LinkCol('Action', endpoint='duel_result',
                       url_kwargs=dict(_id='duel_id'), text_fallback='results')
 
@@ -0,0 +1,49 @@
+import time
+
+import cli
+import challenge
+
+# Cleans up after duels: expires abandoned challenges and deletes the
+#   answer lists of finished or deleted duels.
+# Usage: python duel_sweeper.py (next to the running server)
+# Runs in resumable SCAN batches, see cli.run_batches.
+
+
+def _steps(max_age: int, batch_size: int) -> dict:
+    return {
+        'duels': lambda db, cursor: challenge.sweep_duels(
+            db, cursor, max_age=max_age, batch_size=batch_size),
+        'answer-lists': lambda db, cursor: challenge.sweep_answer_lists(
+            db, cursor, batch_size=batch_size),
+    }
+
+
+def sweep(db, max_age: int, batch_size: int, pause: float):
+    cli.run_batches(db, _steps(max_age, batch_size),
+                    challenge.TABLE_SWEEP_CURSORS, pause)
+
+
+def main():
+    parser = cli.argument_parser('duel sweeper')
+    cli.add_batch_arguments(parser)
+    parser.add_argument('--max-age', type=int,
+                        default=challenge.CHALLENGE_MAX_AGE,
+                        help='seconds until unaccepted challenges expire')
+    parser.add_argument('--interval', type=int, default=60 * 60,
+                        help='seconds between two sweeps')
+    parser.add_argument('--once', action='store_true')
+    args = parser.parse_args()
+
+    db = cli.connect(args)
+
+    while True:
+        sweep(db, args.max_age, args.batch, args.pause)
+
+        if args.once:
+            break
+
+        time.sleep(args.interval)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,55 @@
+import time
+
+import cli
+from model import CardBox, TABLE_RATINGS, TABLE_CONTENT
+from user import User
+
+# Reports references to deleted CardBoxes: rating counters, content,
+#   raters sets, and own boxes, rated boxes and showcases of users.
+# Usage: python integrity_scanner.py [--repair]
+# --repair deletes what it finds. Runs in resumable SCAN batches, see
+#   cli.run_batches.
+
+# scan name -> cursor of the running scan
+TABLE_CURSORS = 'integrity-cursors'
+
+
+def _steps(repair: bool, batch_size: int) -> dict:
+    return {
+        'ratings': lambda db, cursor: CardBox.scan_orphans(
+            db, TABLE_RATINGS, cursor, repair, batch_size),
+        'content': lambda db, cursor: CardBox.scan_orphans(
+            db, TABLE_CONTENT, cursor, repair, batch_size),
+        'raters': lambda db, cursor: CardBox.scan_orphan_raters(
+            db, cursor, repair, batch_size),
+        'users': lambda db, cursor: User.scan_references(
+            db, cursor, repair, batch_size),
+    }
+
+
+def scan(db, repair: bool, batch_size: int, pause: float):
+    cli.run_batches(db, _steps(repair, batch_size), TABLE_CURSORS, pause)
+
+
+def main():
+    parser = cli.argument_parser('integrity scanner')
+    cli.add_batch_arguments(parser)
+    parser.add_argument('--repair', action='store_true',
+                        help='delete dangling references')
+    parser.add_argument('--interval', type=int, default=None,
+                        help='repeat the scan after this many seconds')
+    args = parser.parse_args()
+
+    db = cli.connect(args)
+
+    while True:
+        scan(db, args.repair, args.batch, args.pause)
+
+        if args.interval is None:
+            break
+
+        time.sleep(args.interval)
+
+
+if __name__ == "__main__":
+    main()
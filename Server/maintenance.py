@@ -0,0 +1,198 @@
+import numpy
+
+import cli
+import utils
+import challenge
+from model import CardBox, Card, TABLE_CONTENT
+from model import TABLE_RATINGS
+from user import (User, TABLE_USER, TABLE_SCORE, TABLE_FOLLOWER_COUNTS,
+                  SCORE_PER_RATING, SCORE_PER_FOLLOWER, SCORE_PER_CARDBOX,
+                  _read_users)
+
+# Maintenance commands for an existing redis database.
+# Usage: python maintenance.py <command>
+
+
+def migrate_records(db):
+    count = CardBox.migrate_records(db)
+    print(f'Rewrote {count} CardBox documents in the current format.')
+
+
+def train_content_dictionary(db):
+    zdict_id = Card.train_dictionary(db)
+
+    if not zdict_id:
+        print('There is no content to train a dictionary on.')
+        return
+
+    print(f'New content is compressed with dictionary {zdict_id}.')
+
+
+def compress_content(db):
+    count = Card.recompress(db, TABLE_CONTENT)
+    count += Card.recompress(db, challenge.TABLE_SNAPSHOTS)
+    print(f'Re-encoded {count} content blobs.')
+
+
+def rebuild_indexes(db):
+    count = CardBox.rebuild_indexes(db)
+    print(f'Indexed {count} CardBoxes.')
+
+
+def migrate_users(db):
+    count = User.migrate_users(db)
+    print(f'Split {count} json user documents into fields.')
+
+
+def rebuild_followers(db):
+    count = User.rebuild_followers(db)
+    print(f'Rebuilt followers of {count} users.')
+
+
+def _scan_counts(db, table: str) -> dict:
+    return {key.decode('utf-8'): int(value)
+            for key, value in db.hscan_iter(table, count=1000)}
+
+
+def _scan_scores(db, key: str) -> dict:
+    return {member.decode('utf-8'): score
+            for member, score in db.zscan_iter(key, count=1000)}
+
+
+# Swaps in the rebuilt scores and keeps the live ones under another key.
+# KEYS: score zset, rebuilt zset, key for the replaced zset
+_SWAP_SCORES_SCRIPT = utils.LuaScript("""
+redis.call('DEL', KEYS[3])
+if redis.call('EXISTS', KEYS[1]) == 1 then
+    redis.call('RENAME', KEYS[1], KEYS[3])
+end
+redis.call('RENAME', KEYS[2], KEYS[1])
+""")
+
+
+def rebuild_scores(db, batch_size=1000):
+    """ Recomputes all scores at once, like User.update_score does for
+      one user: streams users, ratings and follower counts, sums them up
+      in arrays and swaps in the new 'score' zset with RENAME.
+    Users registered meanwhile keep their current score. Live scores that
+      changed during the rebuild (ratings, score worker) would be lost by
+      the swap, so those users are queued for a recompute afterwards.
+    """
+    live_before = _scan_scores(db, TABLE_SCORE)
+    ratings = _scan_counts(db, TABLE_RATINGS)
+    followers = _scan_counts(db, TABLE_FOLLOWER_COUNTS)
+
+    user_ids = [user_id.decode('utf-8')
+                for user_id, _ in db.hscan_iter(TABLE_USER, count=batch_size)]
+
+    offline = numpy.zeros(len(user_ids), dtype=numpy.int64)
+    num_boxes = numpy.zeros(len(user_ids), dtype=numpy.int64)
+    box_ratings = []
+
+    for start in range(0, len(user_ids), batch_size):
+        # one record per id, None for users deleted meanwhile
+        users = _read_users(db, user_ids[start:start + batch_size])
+
+        for i, user in enumerate(users, start=start):
+            if not user:
+                continue
+
+            cardboxs = user.get('cardboxs', [])
+            offline[i] = user.get('offline_score', 0)
+            num_boxes[i] = len(cardboxs)
+            box_ratings.extend(ratings.get(_id, 0) for _id in cardboxs)
+
+    # box_ratings lists the ratings of the boxes of user 0, user 1, ...
+    owners = numpy.repeat(numpy.arange(len(user_ids)), num_boxes)
+    likes = numpy.bincount(owners, weights=box_ratings,
+                           minlength=len(user_ids)).astype(numpy.int64)
+    num_followers = numpy.array([followers.get(_id, 0) for _id in user_ids],
+                                dtype=numpy.int64)
+
+    scores = (offline + likes * SCORE_PER_RATING +
+              num_followers * SCORE_PER_FOLLOWER +
+              num_boxes * SCORE_PER_CARDBOX)
+
+    temp_key = TABLE_SCORE + '_rebuild'
+    pipe = db.pipeline(transaction=False)
+    pipe.delete(temp_key)
+
+    for start in range(0, len(user_ids), batch_size):
+        pipe.zadd(temp_key, {_id: int(score) for _id, score in
+                             zip(user_ids[start:start + batch_size],
+                                 scores[start:start + batch_size])})
+        pipe.execute()
+
+    rebuilt = set(user_ids)
+    late_ids = [user_id.decode('utf-8')
+                for user_id, _ in db.hscan_iter(TABLE_USER, count=batch_size)
+                if user_id.decode('utf-8') not in rebuilt]
+
+    if late_ids:
+        current = User.scores_of(db, late_ids)
+        db.zadd(temp_key, dict(zip(late_ids, current)))
+        User.mark_score_dirty(db, *late_ids)
+
+    if user_ids or late_ids:
+        replaced_key = TABLE_SCORE + '_replaced'
+        _SWAP_SCORES_SCRIPT(db, keys=[TABLE_SCORE, temp_key, replaced_key])
+
+        changed = [_id for _id, score in
+                   _scan_scores(db, replaced_key).items()
+                   if live_before.get(_id) != score]
+        db.delete(replaced_key)
+
+        if changed:
+            User.mark_score_dirty(db, *changed)
+
+    print(f'Recomputed the scores of {len(user_ids)} users.')
+
+
+def rebuild_counters(db):
+    count = 0
+
+    for user_id, _ in db.hscan_iter(TABLE_USER, count=500):
+        challenge.rebuild_counters(db, user_id.decode('utf-8'))
+        count += 1
+
+    print(f'Recounted challenges of {count} users.')
+
+
+def migrate_snapshots(db):
+    count = 0
+
+    for duel_id, json_string in db.hscan_iter(challenge.TABLE_VS, count=100):
+        if b'"box_content"' not in json_string:
+            continue
+
+        if challenge.migrate_to_snapshot(db, duel_id.decode('utf-8')):
+            count += 1
+
+    print(f'Moved the content of {count} duels into snapshots.')
+
+
+COMMANDS = {
+    'rebuild-indexes': rebuild_indexes,
+    'migrate-users': migrate_users,
+    'migrate-records': migrate_records,
+    'rebuild-followers': rebuild_followers,
+    'rebuild-scores': rebuild_scores,
+    'rebuild-counters': rebuild_counters,
+    'migrate-snapshots': migrate_snapshots,
+    'train-content-dictionary': train_content_dictionary,
+    'compress-content': compress_content,
+}
+
+
+def main():
+    parser = cli.argument_parser('database maintenance')
+    parser.add_argument('command', choices=sorted(COMMANDS.keys()))
+    args = parser.parse_args()
+
+    db = cli.connect(args)
+
+    COMMANDS[args.command](db)
+
+
+if __name__ == "__main__":
+    main()
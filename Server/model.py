@@ -1,15 +1,56 @@
 import json
+import zlib
 import uuid
 import base64
+import hashlib
 
 
 import utils
+from cache import records, fetch_objects
 
 
+# box id -> number of ratings; the only place a rating is kept,
+#   box reads join it in
 TABLE_RATINGS = 'ratings'
+# set of the ids of the users who rated a box, the reverse of their
+#   rated sets (see user.RATED_SUFFIX)
+RATERS_SUFFIX = '_raters'
 TABLE_CARDBOXES = 'cardboxs'
 TABLE_CONTENT = 'cards'
 
+# Content blobs are json, or compressed json once they reach
+#   COMPRESS_MIN_SIZE bytes: CONTENT_ZLIB + zlib stream, or
+#   CONTENT_ZDICT + dictionary id + zlib stream using that preset dictionary.
+# Dictionaries are trained on the stored content (Card.train_dictionary),
+#   kept by id in TABLE_CONTENT_DICTS and never removed.
+COMPRESS_MIN_SIZE = 512
+CONTENT_ZLIB = b'\x01'
+CONTENT_ZDICT = b'\x02'
+ZDICT_ID_LENGTH = 8
+TABLE_CONTENT_DICTS = 'cards_dicts'
+CONTENT_DICT_CURRENT = 'cards_dict_current'
+
+INDEX_RATING = 'cardboxs_by_rating'
+INDEX_NAME = 'cardboxs_by_name'
+INDEX_OWNER = 'cardboxs_by_owner'
+
+# lexicographic indexes store '<lowercase value><separator><box id>' members
+# with score 0, so redis orders them by value first and id second
+LEX_SEPARATOR = '\x00'
+
+# one set of box ids per tag
+INDEX_TAG_PREFIX = 'cardboxs_tagged_'
+# box id -> json list of lowercase name and owner, used to order filter results
+TABLE_LEX = 'cardboxs_lex'
+LEX_FIELDS = ('name', 'owner')
+# one set of box ids per trigram of the lowercase name/owner
+INDEX_TRIGRAM_PREFIXES = dict(name='cardboxs_trigram_name_',
+                              owner='cardboxs_trigram_owner_')
+
+# ordered box ids of a filtered query, kept for paging through the results
+RESULTS_PREFIX = 'cardboxs_results_'
+RESULTS_TTL = 300
+
 DEFAULT_INFO = "We are sure this is an amazing CardBox!"
 
 
@@ -30,63 +71,120 @@ class CardBox:
         return base64.urlsafe_b64encode(uuid.uuid4().bytes).decode('utf-8')
 
     def store(self, db):
-        db.hset(TABLE_CARDBOXES, self._id, utils.jsonify(self))
-
-    def increment_rating(self, db, user):
-        if self._id in user.rated:
-            # already incremented
-            return False
-
-        try:
-            db.hincrby(TABLE_RATINGS, self._id, amount=1)
-        except:
-            # TODO: check exception circumstance and re-raise accordingly
-            return False
-
-        user.rated.append(self._id)
-        user.store(db)
-
-        try:
-            self.rating = int(db.hget(TABLE_RATINGS, self._id).decode('utf-8'))
-        except:
-            # TODO: check exception circumstance and re-raise accordingly
-            return False
-
-        self.store(db)
-
-        # success
-        return True
+        """ Writes the box and moves it in the indexes.
+        The old document is read from redis while TABLE_CARDBOXES is
+          watched, so concurrent stores of the same box cannot leave index
+          entries of each other behind. Box documents only change on
+          upload, so the watch rarely conflicts.
+        """
+        def _store(pipe):
+            document = pipe.hget(TABLE_CARDBOXES, self._id)
+
+            pipe.multi()
+
+            if document:
+                old_box = CardBox(**_decode_boxes([document], [0])[0])
+                old_box._unindex(pipe)
+
+            pipe.hset(TABLE_CARDBOXES, self._id, self.encode())
+            records.invalidate(pipe, TABLE_CARDBOXES, self._id)
+            self._index(pipe)
+
+        db.transaction(_store, TABLE_CARDBOXES)
+
+    def encode(self) -> bytes:
+        """ The stored document, without the rating (see TABLE_RATINGS). """
+        return utils.encode_record({key: value
+                                    for key, value in vars(self).items()
+                                    if key != 'rating'})
+
+    def _index(self, pipe):
+        # ratings only change by the rating script, updates keep the score
+        pipe.zadd(INDEX_RATING, {self._id: self.rating}, nx=True)
+        pipe.zadd(INDEX_NAME, {_lex_member(self.name, self._id): 0})
+        pipe.zadd(INDEX_OWNER, {_lex_member(self.owner, self._id): 0})
+        pipe.hset(TABLE_LEX, self._id,
+                  json.dumps([self.name.lower(), self.owner.lower()]))
+
+        for tag in set(self.tags):
+            pipe.sadd(INDEX_TAG_PREFIX + tag, self._id)
+
+        for field, prefix in INDEX_TRIGRAM_PREFIXES.items():
+            for gram in _trigrams(getattr(self, field)):
+                pipe.sadd(prefix + gram, self._id)
+
+    def _unindex(self, pipe):
+        pipe.zrem(INDEX_NAME, _lex_member(self.name, self._id))
+        pipe.zrem(INDEX_OWNER, _lex_member(self.owner, self._id))
+        pipe.hdel(TABLE_LEX, self._id)
+
+        for tag in set(self.tags):
+            pipe.srem(INDEX_TAG_PREFIX + tag, self._id)
+
+        for field, prefix in INDEX_TRIGRAM_PREFIXES.items():
+            for gram in _trigrams(getattr(self, field)):
+                pipe.srem(prefix + gram, self._id)
 
     @staticmethod
-    def delete(db, cardbox_id: str):
-        db.hdel(TABLE_CARDBOXES, cardbox_id)
+    def delete(db, cardbox_id: str) -> list:
+        """ Deletes the box with its rating, indexes and content.
+        Returns the ids of the users who rated the box; their rated sets
+          still hold it, see User.delete_cardbox.
+        """
+        box = CardBox.fetch(db, cardbox_id)
+
+        pipe = db.pipeline()
+        # first, so its reply is the first one
+        pipe.smembers(cardbox_id + RATERS_SUFFIX)
+        pipe.delete(cardbox_id + RATERS_SUFFIX)
+
+        if box:
+            box._unindex(pipe)
+
+        pipe.hdel(TABLE_CARDBOXES, cardbox_id)
+        pipe.hdel(TABLE_RATINGS, cardbox_id)
+        pipe.zrem(INDEX_RATING, cardbox_id)
+        records.invalidate(pipe, TABLE_CARDBOXES, cardbox_id)
+        raters = pipe.execute()[0]
+
         Card.remove_content(db, cardbox_id)
-        return True
+        return sorted(rater.decode('utf-8') for rater in raters)
 
     @staticmethod
     def fetch(db, cardbox_id: str):
         if not cardbox_id:
             return None
 
-        json_string = db.hget(TABLE_CARDBOXES, cardbox_id)
+        return fetch_objects(db, TABLE_CARDBOXES, [cardbox_id], CardBox,
+                             read=_read_boxes)[0]
 
-        if not json_string:
-            return None
+    @staticmethod
+    def fetch_with_content(db, cardbox_id: str):
+        """ Returns the CardBox and its content, read in one round trip. """
+        if not cardbox_id:
+            return None, None
+
+        pipe = db.pipeline(transaction=False)
+        pipe.hget(TABLE_CARDBOXES, cardbox_id)
+        pipe.hget(TABLE_RATINGS, cardbox_id)
+        pipe.hget(TABLE_CONTENT, cardbox_id)
+        document, rating, cards = pipe.execute()
+
+        if not document:
+            return None, None
 
-        return CardBox(**utils.unjsonify(json_string))
+        return (CardBox(**_decode_boxes([document], [rating])[0]),
+                Card.decode_content(db, cards))
 
     @staticmethod
     def fetch_multiple(db, cardbox_ids: list):
         if not cardbox_ids:
             return []
 
-        json_strings = db.hmget(TABLE_CARDBOXES, *cardbox_ids)
-
-        if not json_strings:
-            return []
-
-        return [CardBox(**utils.unjsonify(json_string))
-                for json_string in json_strings]
+        return [box for box in
+                fetch_objects(db, TABLE_CARDBOXES, cardbox_ids, CardBox,
+                              read=_read_boxes)
+                if box]
 
     @staticmethod
     def fetch_all(db):
@@ -95,11 +193,350 @@ class CardBox:
         if not dict_json_boxes:
             return []
 
-        boxes = [CardBox(**utils.unjsonify(d))
-                 for d in dict_json_boxes.values()]
+        ratings = db.hgetall(TABLE_RATINGS)
+
+        boxes = [CardBox(**record) for record in
+                 _decode_boxes(dict_json_boxes.values(),
+                               [ratings.get(_id) for _id in dict_json_boxes])]
 
         return boxes
 
+    @staticmethod
+    def exists_multiple(db, cardbox_ids: list) -> list:
+        pipe = db.pipeline(transaction=False)
+
+        for _id in cardbox_ids:
+            pipe.hexists(TABLE_CARDBOXES, _id)
+
+        return pipe.execute()
+
+    @staticmethod
+    def scan_orphans(db, table: str, cursor=0, repair=False,
+                     batch_size=100):
+        """ Visits one HSCAN batch of 'table', a hash keyed by box id like
+          TABLE_RATINGS or TABLE_CONTENT, and counts the entries of boxes
+          that do not exist; 'repair' deletes them.
+        Returns the next cursor, 0 after the last batch, and the counts.
+        """
+        cursor, batch = db.hscan(table, cursor, count=batch_size)
+        ids = [_id.decode('utf-8') for _id in batch]
+
+        orphans = [_id for _id, exists in
+                   zip(ids, CardBox.exists_multiple(db, ids)) if not exists]
+
+        if repair and orphans:
+            pipe = db.pipeline()
+            pipe.hdel(table, *orphans)
+
+            if table == TABLE_RATINGS:
+                pipe.zrem(INDEX_RATING, *orphans)
+
+            pipe.execute()
+
+        return cursor, dict(scanned=len(ids), orphans=len(orphans))
+
+    @staticmethod
+    def scan_orphan_raters(db, cursor=0, repair=False, batch_size=100):
+        """ Visits one SCAN batch of the keyspace and counts the raters
+          sets of boxes that do not exist; 'repair' deletes them.
+        Returns the next cursor, 0 after the last batch, and the counts.
+        """
+        cursor, keys = db.scan(cursor, match='*' + RATERS_SUFFIX,
+                               count=batch_size)
+        keys = [key.decode('utf-8') for key in keys]
+        ids = [key[:-len(RATERS_SUFFIX)] for key in keys]
+
+        orphans = [key for key, exists in
+                   zip(keys, CardBox.exists_multiple(db, ids)) if not exists]
+
+        if repair and orphans:
+            db.delete(*orphans)
+
+        return cursor, dict(scanned=len(keys), orphans=len(orphans))
+
+    @staticmethod
+    def sort_ids(db, cardbox_ids, sort_key='rating', reverse=False) -> list:
+        """ Orders the given ids like the sort index of 'sort_key' would,
+        without fetching the CardBoxes themselves.
+        """
+        if sort_key not in SORT_INDEXES:
+            raise ValueError(sort_key)
+
+        cardbox_ids = list(cardbox_ids)
+
+        if not cardbox_ids:
+            return []
+
+        if sort_key == 'rating':
+            pipe = db.pipeline(transaction=False)
+            for cardbox_id in cardbox_ids:
+                pipe.zscore(INDEX_RATING, cardbox_id)
+            values = [score or 0 for score in pipe.execute()]
+        else:
+            position = LEX_FIELDS.index(sort_key)
+            values = [_lex_field(v, position) if v else ''
+                      for v in db.hmget(TABLE_LEX, *cardbox_ids)]
+
+        ordered = sorted(zip(values, cardbox_ids), reverse=reverse)
+
+        return [cardbox_id for _, cardbox_id in ordered]
+
+    @staticmethod
+    def tagged_ids(db, tags: list, match_all=True) -> set:
+        """ Ids of all CardBoxes carrying every (match_all) or
+        any (not match_all) of the given tags.
+        """
+        if not tags:
+            return set()
+
+        keys = [INDEX_TAG_PREFIX + tag for tag in tags]
+
+        members = db.sinter(*keys) if match_all else db.sunion(*keys)
+
+        return {m.decode('utf-8') for m in members}
+
+    @staticmethod
+    def search_ids(db, field: str, term: str) -> list:
+        """ Ids of all CardBoxes whose name/owner (field) contains 'term',
+        ignoring case. The trigram index narrows down the candidates,
+          which are then checked exactly.
+        Terms shorter than three characters fall back to a scan of the
+          lowercase names.
+        """
+        if field not in INDEX_TRIGRAM_PREFIXES:
+            raise ValueError(field)
+
+        term = term.lower()
+        grams = _trigrams(term)
+
+        if grams:
+            prefix = INDEX_TRIGRAM_PREFIXES[field]
+            candidates = [c.decode('utf-8')
+                          for c in db.sinter(*[prefix + g for g in grams])]
+
+            if not candidates:
+                return []
+
+            pairs = zip(candidates, db.hmget(TABLE_LEX, *candidates))
+        else:
+            pairs = ((k.decode('utf-8'), v)
+                     for k, v in db.hscan_iter(TABLE_LEX, count=500))
+
+        position = LEX_FIELDS.index(field)
+
+        return [cardbox_id for cardbox_id, value in pairs
+                if value and term in _lex_field(value, position)]
+
+    @staticmethod
+    def index_source(db, sort_key='rating', reverse=False):
+        """ All CardBoxes in the order of a sort index, fetched lazily. """
+        def loader(members):
+            return CardBox.fetch_multiple(db,
+                                          _ids_of_members(sort_key, members))
+
+        return utils.SortedSetSource(db, SORT_INDEXES[sort_key], reverse,
+                                     loader=loader)
+
+    @staticmethod
+    def list_source(db, cardbox_ids: list):
+        """ CardBoxes of an ordered list of ids, fetched lazily. """
+        def loader(ids):
+            return CardBox.fetch_multiple(db, ids)
+
+        return utils.ListSource(cardbox_ids, loader=loader)
+
+    @staticmethod
+    def store_results(db, query: tuple, cardbox_ids: list):
+        """ Keeps the ordered ids of a query result for RESULTS_TTL seconds.
+        Returns the snapshot token to find them again, None if there are
+          no ids to keep.
+        """
+        if not cardbox_ids:
+            return None
+
+        token = uuid.uuid4().hex
+        key = _results_key(query, token)
+
+        pipe = db.pipeline()
+        pipe.rpush(key, *cardbox_ids)
+        pipe.expire(key, RESULTS_TTL)
+        pipe.execute()
+
+        return token
+
+    @staticmethod
+    def results_source(db, query: tuple, token: str):
+        """ CardBoxes of a kept query result, fetched lazily; None if the
+          snapshot expired or was taken for another query.
+        Every access renews the TTL of the snapshot.
+        """
+        key = _results_key(query, token)
+
+        if not db.expire(key, RESULTS_TTL):
+            return None
+
+        def loader(ids):
+            return CardBox.fetch_multiple(db, ids)
+
+        return utils.RedisListSource(db, key, loader=loader)
+
+    @staticmethod
+    def migrate_records(db, batch_size=500) -> int:
+        """ Rewrites all documents of an older format; reading a box does
+          the same lazily.
+        """
+        count = 0
+        batch = []
+
+        for cardbox_id, document in db.hscan_iter(TABLE_CARDBOXES,
+                                                  count=batch_size):
+            if utils.is_outdated(document):
+                batch.append((cardbox_id.decode('utf-8'), document))
+
+            if len(batch) == batch_size:
+                count += _rewrite_outdated_batch(db, batch)
+                batch.clear()
+
+        if batch:
+            count += _rewrite_outdated_batch(db, batch)
+
+        return count
+
+    @staticmethod
+    def rebuild_indexes(db, batch_size=500) -> int:
+        db.delete(*SORT_INDEXES.values(), TABLE_LEX)
+
+        prefixes = [INDEX_TAG_PREFIX] + list(INDEX_TRIGRAM_PREFIXES.values())
+
+        for prefix in prefixes:
+            for key in db.scan_iter(match=prefix + '*', count=batch_size):
+                db.delete(key)
+
+        count = 0
+        pipe = db.pipeline()
+        batch = []
+
+        def index_batch():
+            ratings = db.hmget(TABLE_RATINGS, *[_id for _id, _ in batch])
+
+            for record in _decode_boxes([j for _, j in batch], ratings):
+                CardBox(**record)._index(pipe)
+
+            pipe.execute()
+            batch.clear()
+
+        for cardbox_id, document in db.hscan_iter(TABLE_CARDBOXES,
+                                                  count=batch_size):
+            batch.append((cardbox_id, document))
+            count += 1
+
+            if len(batch) == batch_size:
+                index_batch()
+
+        if batch:
+            index_batch()
+
+        return count
+
+
+SORT_INDEXES = dict(rating=INDEX_RATING, name=INDEX_NAME, owner=INDEX_OWNER)
+
+
+def _decode_boxes(documents, ratings) -> list:
+    """ Box kwargs of stored documents with the given ratings joined in,
+      None for missing documents.
+    """
+    boxes = []
+
+    for document, rating in zip(documents, ratings):
+        if not document:
+            boxes.append(None)
+            continue
+
+        box = utils.decode_record(document)
+        box['rating'] = int(rating or 0)
+        boxes.append(box)
+
+    return boxes
+
+
+def _read_boxes(db, cardbox_ids: list) -> list:
+    pipe = db.pipeline(transaction=False)
+    pipe.hmget(TABLE_CARDBOXES, *cardbox_ids)
+    pipe.hmget(TABLE_RATINGS, *cardbox_ids)
+    documents, ratings = pipe.execute()
+
+    boxes = _decode_boxes(documents, ratings)
+    _rewrite_outdated(db, cardbox_ids, documents, boxes)
+
+    return boxes
+
+
+def _rewrite_outdated(db, cardbox_ids, documents, boxes) -> int:
+    """ Rewrites documents of an older format (e.g. json) unless they
+      changed since they were read; 'boxes' are the decoded documents.
+    """
+    pipe = db.pipeline(transaction=False)
+    count = 0
+
+    for _id, document, box in zip(cardbox_ids, documents, boxes):
+        if document and utils.is_outdated(document):
+            utils.REPLACE_FIELD_SCRIPT(pipe, keys=[TABLE_CARDBOXES],
+                                       args=[_id, document,
+                                             CardBox(**box).encode()])
+            count += 1
+
+    if count:
+        pipe.execute()
+
+    return count
+
+
+def _rewrite_outdated_batch(db, batch: list) -> int:
+    ids = [_id for _id, _ in batch]
+    documents = [document for _, document in batch]
+
+    return _rewrite_outdated(db, ids, documents,
+                             _decode_boxes(documents, [0] * len(batch)))
+
+
+_content_dicts = {}
+
+
+def _content_dict(db, zdict_id: bytes) -> bytes:
+    # dictionaries never change, so every process keeps the ones it used
+    if zdict_id not in _content_dicts:
+        _content_dicts[zdict_id] = db.hget(TABLE_CONTENT_DICTS, zdict_id)
+
+    return _content_dicts[zdict_id]
+
+
+def _lex_member(value: str, cardbox_id: str) -> str:
+    return value.lower() + LEX_SEPARATOR + cardbox_id
+
+
+def _results_key(query: tuple, token: str) -> str:
+    # the query is part of the key, so a token only matches its own query
+    digest = hashlib.sha1(json.dumps(query).encode('utf-8')).hexdigest()
+
+    return f'{RESULTS_PREFIX}{digest}_{token}'
+
+
+def _ids_of_members(sort_key: str, members: list) -> list:
+    if sort_key == 'rating':
+        return members
+
+    return [m.rsplit(LEX_SEPARATOR, 1)[1] for m in members]
+
+
+def _lex_field(json_string: bytes, position: int) -> str:
+    return json.loads(json_string.decode('utf-8'))[position]
+
+
+def _trigrams(value: str) -> set:
+    value = value.lower()
+    return {value[i:i + 3] for i in range(len(value) - 2)}
+
 
 class Card:
 
@@ -120,7 +557,7 @@ class Card:
                        correct_answers=correct_answers,
                        explanations=explanations)
 
-        db.hset(TABLE_CONTENT, box_id, json.dumps(content))
+        db.hset(TABLE_CONTENT, box_id, Card.encode_content(db, content))
 
     @staticmethod
     def fetch_content_to_list(db, box_id: str):
@@ -155,13 +592,96 @@ class Card:
 
     @staticmethod
     def fetch_content(db, box_id: str):
-        cards = db.hget(TABLE_CONTENT, box_id)
+        return Card.decode_content(db, db.hget(TABLE_CONTENT, box_id))
+
+    @staticmethod
+    def encode_content(db, content: dict) -> bytes:
+        data = json.dumps(content, sort_keys=True).encode('utf-8')
+
+        if len(data) < COMPRESS_MIN_SIZE:
+            return data
+
+        zdict_id = db.get(CONTENT_DICT_CURRENT)
 
+        if not zdict_id:
+            return CONTENT_ZLIB + zlib.compress(data)
+
+        compressor = zlib.compressobj(zdict=_content_dict(db, zdict_id))
+
+        return (CONTENT_ZDICT + zdict_id +
+                compressor.compress(data) + compressor.flush())
+
+    @staticmethod
+    def decode_content(db, cards: bytes):
         if not cards:
             return None
 
+        if cards[:1] == CONTENT_ZLIB:
+            cards = zlib.decompress(cards[1:])
+
+        elif cards[:1] == CONTENT_ZDICT:
+            zdict_id = cards[1:1 + ZDICT_ID_LENGTH]
+            decompressor = zlib.decompressobj(zdict=_content_dict(db,
+                                                                  zdict_id))
+            cards = decompressor.decompress(cards[1 + ZDICT_ID_LENGTH:])
+
         return json.loads(cards.decode('utf-8'))
 
+    @staticmethod
+    def train_dictionary(db, samples=500, size=32768) -> str:
+        """ Builds a preset dictionary for zlib from the stored content
+          and makes it the one used for new content; returns its id.
+        zlib matches against the whole dictionary, preferring its end, so
+          it is just the concatenation of sample content up to 'size' bytes.
+        """
+        parts = []
+
+        for _, cards in db.hscan_iter(TABLE_CONTENT, count=samples):
+            content = Card.decode_content(db, cards)
+            parts.append(json.dumps(content, sort_keys=True).encode('utf-8'))
+
+            if len(parts) == samples:
+                break
+
+        zdict = b''.join(parts)[-size:]
+
+        if not zdict:
+            return None
+
+        zdict_id = hashlib.sha1(zdict).hexdigest()[:ZDICT_ID_LENGTH]
+
+        pipe = db.pipeline()
+        pipe.hsetnx(TABLE_CONTENT_DICTS, zdict_id, zdict)
+        pipe.set(CONTENT_DICT_CURRENT, zdict_id)
+        pipe.execute()
+
+        return zdict_id
+
+    @staticmethod
+    def recompress(db, table=TABLE_CONTENT, batch_size=500) -> int:
+        """ Re-encodes all blobs of 'table' (content or duel snapshots)
+          with the current settings, skipping blobs changed meanwhile.
+        """
+        count = 0
+        pipe = db.pipeline(transaction=False)
+
+        for field, cards in db.hscan_iter(table, count=batch_size):
+            encoded = Card.encode_content(db, Card.decode_content(db, cards))
+
+            if encoded == cards:
+                continue
+
+            utils.REPLACE_FIELD_SCRIPT(pipe, keys=[table],
+                                       args=[field, cards, encoded])
+            count += 1
+
+            if count % batch_size == 0:
+                pipe.execute()
+
+        pipe.execute()
+
+        return count
+
     @staticmethod
     def remove_content(db, box_id: str):
         db.hdel(TABLE_CONTENT, box_id)
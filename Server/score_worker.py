@@ -0,0 +1,58 @@
+import time
+import logging
+
+import redis
+
+import cli
+from user import User
+
+# Recomputes the scores of users queued by User.mark_score_dirty.
+# Usage: python score_worker.py (next to the running server)
+# Any number of workers may run; each queued user is popped by one of them.
+# Failed recomputes are logged and queued again; while redis is unreachable
+#   the worker keeps the popped users and retries with a growing delay.
+
+MAX_BACKOFF = 60
+
+
+def run(db, batch_size: int, timeout: int):
+    failed = []
+    backoff = 1
+
+    while True:
+        try:
+            if failed:
+                User.requeue_scores(db, failed)
+                failed = []
+
+            user_ids = User.pop_dirty_scores(db, batch_size)
+            failed = User.update_scores(db, user_ids)
+
+            # nothing to do, or nothing but failures: don't spin on them
+            if len(failed) == len(user_ids):
+                User.wait_for_dirty_scores(db, timeout)
+
+            backoff = 1
+
+        except redis.ConnectionError:
+            logging.exception('Redis is unreachable, retrying in %ss',
+                              backoff)
+            time.sleep(backoff)
+            backoff = min(backoff * 2, MAX_BACKOFF)
+
+
+def main():
+    parser = cli.argument_parser('score worker')
+    parser.add_argument('--batch', type=int, default=100)
+    parser.add_argument('--timeout', type=int, default=5)
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(asctime)s %(levelname)s %(message)s')
+
+    db = cli.connect(args)
+
+    run(db, args.batch, args.timeout)
+
+
+if __name__ == "__main__":
+    main()
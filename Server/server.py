@@ -11,8 +11,10 @@ from werkzeug.urls import url_parse
 
 import utils
 import challenge
+from cache import records
 from model import CardBox, Card
-from user import User, RegistrationForm, LoginForm, ChangePasswordForm
+from user import (User, ScoreboardView, RegistrationForm, LoginForm,
+                  ChangePasswordForm)
 from display import (CardBoxTable, UserTable, ScoreTable, ChooseBoxTable,
                      FilterForm, CommunityForm, ShowcaseForm, PictureForm,
                      ConfirmationForm, ChallengeFilterForm,
@@ -28,6 +30,7 @@ app.secret_key = ('34c059badbbd38455b4eb44865c25303'
                   '582a6056565be9eee146f46b7079ff95')
 
 db = redis.StrictRedis(host='localhost', port=6379, db=0)
+records.enable(db)
 
 # configure Login Manager:
 login_manager = LoginManager(app)
@@ -65,6 +68,49 @@ def favicon():
 """
 
 
+def query_cardboxes(filter_option, filter_term, sort_key, reverse,
+                    snapshot=None):
+    """ Returns the CardBoxes matching the filter in the requested order
+      and the snapshot token of the result, if any.
+    Unfiltered queries are served as a lazy view on the sort index, filtered
+      queries resolve their ids on the tag/trigram indexes. The ids of a
+      filtered result are kept in redis for a few minutes, so following
+      pages are read from that snapshot instead of querying again and rows
+      do not shift between pages. In all cases only the displayed page of
+      CardBoxes is fetched from redis.
+    """
+    if not filter_term:
+        return CardBox.index_source(db, sort_key, reverse), None
+
+    query = (filter_option, filter_term, sort_key, reverse)
+
+    if snapshot:
+        cardboxes = CardBox.results_source(db, query, snapshot)
+
+        if cardboxes is not None:
+            return cardboxes, snapshot
+
+    # <-- tag filter -->
+    # whitespace separated tags must all be present;
+    #   tags separated by ' | ' match if any of them is present
+    if filter_option == 'tags':
+        tags = filter_term.split()
+        match_all = '|' not in tags
+        tags = [tag for tag in tags if tag != '|']
+
+        cardbox_ids = CardBox.tagged_ids(db, tags, match_all=match_all)
+
+    # <-- substring filter -->
+    # checks for filter_option = 'name', 'owner' if term is part of string
+    else:
+        cardbox_ids = CardBox.search_ids(db, filter_option, filter_term)
+
+    cardbox_ids = CardBox.sort_ids(db, cardbox_ids, sort_key, reverse)
+    snapshot = CardBox.store_results(db, query, cardbox_ids)
+
+    return CardBox.list_source(db, cardbox_ids), snapshot
+
+
 @app.route('/cardboxes/<_id>')
 @login_required
 def show_box(_id):
@@ -100,8 +146,7 @@ def rate_cardbox(_id):
         flash('Invalid Cardbox ID.', 'error')
         return redirect(url_for('index'))
 
-    if box.increment_rating(db, current_user):
-        User.update_score(db, box.owner)
+    if current_user.rate(db, box):
         flash('Successfully rated. Thank you for your appreciation! :3')
         return redirect(url_for('show_box', _id=_id))
 
@@ -128,12 +173,7 @@ def delete_cardbox(_id):
 
     if form.is_submitted():
 
-        CardBox.delete(db, _id)
-
-        current_user.cardboxs.remove(box._id)
-
-        current_user.store(db)
-        User.update_score(db, current_user._id)
+        current_user.delete_cardbox(db, box._id)
 
         flash("Successfully removed CardBox")
         return redirect(url_for('huge_list',
@@ -156,6 +196,7 @@ def huge_list():
     page = args.get('page')
     filter_option = args.get('foption')
     filter_term = args.get('fterm')
+    snapshot = args.get('snap')
 
     # <-- validate parameters and set fallback values -->
     sort_key_possible = ('name', 'owner', 'rating')
@@ -186,7 +227,8 @@ def huge_list():
         filter_option = form.option.data
         filter_term = form.term.data
 
-        kwargs = {key: value for key, value in args.items()}
+        kwargs = {key: value for key, value in args.items()
+                  if key != 'snap'}
         kwargs.update(sort=sort_key, direction=sort_direction,
                       foption=filter_option, fterm=filter_term, page=1)
 
@@ -195,31 +237,9 @@ def huge_list():
     form.term.data = filter_term
     form.option.data = filter_option
 
-    cardboxes = CardBox.fetch_all(db)
-
-    # <-- filter process -->
-    # checks for filter_option = 'tags' if term exists in tag list
-    # checks for filter_option = 'name', 'owner' if term is part of string
-    if filter_term:
-        if filter_option == 'name' or filter_option == 'owner':
-            cardboxes = [box for box in cardboxes
-                         if filter_term.lower()
-                         in getattr(box, filter_option).lower()]
-        else:
-            cardboxes = [box for box in cardboxes
-                         if filter_term in getattr(box, filter_option)]
-
-    # <-- sort process -->
-    def _sort_key_of(box):
-        if sort_key == 'name':
-            return box.name.lower()
-        if sort_key == 'owner':
-            return box.owner.lower()
-
-        return getattr(box, sort_key)
-
-    if cardboxes:
-        cardboxes.sort(key=_sort_key_of, reverse=sort_direction_bool)
+    cardboxes, snapshot = query_cardboxes(filter_option, filter_term,
+                                          sort_key, sort_direction_bool,
+                                          snapshot)
 
     # <-- pagination -->
     per_page = 50
@@ -235,7 +255,8 @@ def huge_list():
     # <-- standard values-->
     kwargs = {key: value for key, value in args.items()}
     kwargs.update(sort=sort_key, direction=sort_direction,
-                  foption=filter_option, fterm=filter_term, page=page)
+                  foption=filter_option, fterm=filter_term, page=page,
+                  snap=snapshot)
 
     # <-- creation of dynamic content -->
     pag_kwargs = dict(pagination=pagination, endpoint='huge_list',
@@ -262,14 +283,15 @@ def huge_list():
 @app.route('/user/<_id>')
 @login_required
 def show_user(_id):
-    if not User.exists(db, _id):
+    user = User.fetch(db, _id)
+
+    if not user:
         flash('Invalid User Name.'
               'Be the first User to have this name! :D', 'error')
         return redirect(url_for('index'))
 
-    score = User.update_score(db, _id)
+    score = user.get_score(db)
 
-    user = User.fetch(db, _id)
     picture_filepath = utils.profile_img_path(app, user._id)
 
     # <-- Showcase -->
@@ -342,8 +364,7 @@ def user_settings():
                             show_cardbox=showcase_form.check_cardbox.data,
                             show_rank=showcase_form.check_rank.data)
 
-        current_user.showcase = new_showcase
-        current_user.store(db)
+        current_user.update_fields(db, showcase=new_showcase)
 
         flash('Showcase adjusted!')
 
@@ -367,7 +388,8 @@ def user_settings():
             return redirect(url_for('user_settings'))
 
         current_user.set_password(password_form.new_password.data)
-        current_user.store(db)
+        current_user.update_fields(db,
+                                   password_hash=current_user.password_hash)
 
         flash('Successfully changed password!')
 
@@ -412,9 +434,7 @@ def toggle_follow(_id):
         flash('Invalid User Name.', 'error')
         return redirect(url_for('index'))
 
-    current_user.toggle_follow(_id)
-    current_user.store(db)
-    User.update_score(db, _id)
+    current_user.toggle_follow(db, _id)
 
     return_address = request.referrer or url_for('show_user', _id=_id)
 
@@ -478,41 +498,37 @@ def user_list():
     form.term.data = filter_term
 
     # <-- distinction: followed users - all users -->
+    # users are represented by dicts of id and score; no user is decoded
     if following_bool:
         if not current_user.following:
             return render_template('community.html', search_form=form,
                                    following_bool=following_bool,
                                    active='community', no_table=True)
 
-        users = User.fetch_multiple(db, current_user.following)
-    else:
-        users = User.fetch_all(db)
-
-    # <-- filter process -->
-    if filter_term:
-        users = [user for user in users
-                 if filter_term.lower() in getattr(user, '_id').lower()]
-
-    # <-- create wrapper objects -->
-    def follow_label_producer(item):
-        return 'Unfollow' if current_user.is_following(item._id) else 'Follow'
+        user_ids = current_user.following
+        users = [dict(_id=_id, score=score) for _id, score
+                 in zip(user_ids, User.scores_of(db, user_ids))]
 
-    def score_value_producer(item):
-        return item.raw.get_score(db)
+    elif filter_term or sort_key == 'username':
+        users = User.top_user_dicts(db)
 
-    wrapper = utils.TableItemWrapper(dict(follow_label=follow_label_producer,
-                                          score=score_value_producer))
+    else:
+        # sorted by score: pages come straight from the score zset
+        users = ScoreboardView(db, reverse=sort_direction_bool)
 
-    users = wrapper(users)
+    if isinstance(users, list):
+        # <-- filter process -->
+        if filter_term:
+            users = [user for user in users
+                     if filter_term.lower() in user['_id'].lower()]
 
-    # <-- sort process -->
-    def _sort_key_of(user):
-        if sort_key == 'username':
-            return user._id.lower()
+        # <-- sort process -->
+        def _sort_key_of(user):
+            if sort_key == 'username':
+                return user['_id'].lower()
 
-        return getattr(user, sort_key)
+            return user[sort_key]
 
-    if users:
         users.sort(key=_sort_key_of, reverse=sort_direction_bool)
 
     # <-- pagination -->
@@ -526,6 +542,12 @@ def user_list():
                                   per_page=per_page,
                                   total_count=user_count)
 
+    # <-- create wrapper objects -->
+    def follow_label_producer(item):
+        return 'Unfollow' if current_user.is_following(item._id) else 'Follow'
+
+    wrapper = utils.TableItemWrapper(dict(follow_label=follow_label_producer))
+
     # <-- standard values-->
     kwargs = {key: value for key, value in args.items()}
     kwargs.update(sort=sort_key, direction=sort_direction,
@@ -536,7 +558,7 @@ def user_list():
                       prev='<', next='>', ellipses='...', size='lg',
                       args=kwargs)
 
-    table = UserTable(pagination.items,
+    table = UserTable(wrapper(pagination.items),
                       sort_reverse=sort_direction_bool,
                       sort_by=sort_key)
 
@@ -563,7 +585,7 @@ def score_list():
     except ValueError:
         page = 1
 
-    users = User.top_user_dicts(db)
+    users = ScoreboardView(db)
 
     # <-- pagination -->
     per_page = 50
@@ -618,6 +640,7 @@ def challenge_user(_id):
     page = args.get('page')
     filter_option = args.get('foption')
     filter_term = args.get('fterm')
+    snapshot = args.get('snap')
 
     # <-- validate parameters and set fallback values -->
     sort_key_possible = ('name', 'owner', 'rating')
@@ -648,7 +671,8 @@ def challenge_user(_id):
         filter_option = form.option.data
         filter_term = form.term.data
 
-        kwargs = {key: value for key, value in args.items()}
+        kwargs = {key: value for key, value in args.items()
+                  if key != 'snap'}
         kwargs.update(sort=sort_key, direction=sort_direction,
                       foption=filter_option, fterm=filter_term, page=1)
 
@@ -657,30 +681,9 @@ def challenge_user(_id):
     form.term.data = filter_term
     form.option.data = filter_option
 
-    cardboxes = CardBox.fetch_all(db)
-
-    # <-- filter process -->
-    # checks for filter_option = 'name', 'owner' if term is part of string
-    if filter_term:
-        if filter_option == 'name' or filter_option == 'owner':
-            cardboxes = [box for box in cardboxes
-                         if filter_term.lower()
-                         in getattr(box, filter_option).lower()]
-        else:
-            cardboxes = [box for box in cardboxes
-                         if filter_term in getattr(box, filter_option)]
-
-    # <-- sort process -->
-    def _sort_key_of(box):
-        if sort_key == 'name':
-            return box.name.lower()
-        if sort_key == 'owner':
-            return box.owner.lower()
-
-        return getattr(box, sort_key)
-
-    if cardboxes:
-        cardboxes.sort(key=_sort_key_of, reverse=sort_direction_bool)
+    cardboxes, snapshot = query_cardboxes(filter_option, filter_term,
+                                          sort_key, sort_direction_bool,
+                                          snapshot)
 
     # <-- pagination -->
     per_page = 50
@@ -696,7 +699,8 @@ def challenge_user(_id):
     # <-- standard values-->
     kwargs = {key: value for key, value in args.items()}
     kwargs.update(sort=sort_key, direction=sort_direction,
-                  foption=filter_option, fterm=filter_term, page=page, _id=_id)
+                  foption=filter_option, fterm=filter_term, page=page,
+                  snap=snapshot, _id=_id)
 
     # <-- creation of dynamic content -->
     pag_kwargs = dict(pagination=pagination, endpoint='challenge_user',
@@ -844,7 +848,8 @@ def duel_r(_id):
         flash('You have no rights to access this duel!', 'error')
         return redirect(url_for('duel_list'))
 
-    num_answers = challenge.num_answers_of(db, cuser_id, _id)
+    answers = challenge.answers_in(db, vs_dict, cuser_id)
+    num_answers = len(answers)
 
     if num_answers == 0:
         return redirect(url_for('duel', _id=_id))
@@ -852,14 +857,14 @@ def duel_r(_id):
     # pointer to last answer card
     index = num_answers - 1
 
+    challenge.load_content(db, vs_dict)
     card = challenge.get_card_from_duel(vs_dict, index)
-    answers = challenge.answers_of(db, cuser_id, _id)
     last_choice = answers[index]
     last_choice_letter = 'abc'[last_choice]
     cardbox_size = challenge.duel_length(vs_dict)
     cardbox_name = vs_dict['box_name']
 
-    correct = vs_dict['box_content']['correct_answers'][:num_answers]
+    correct = challenge.correct_answers_of(vs_dict)[:num_answers]
     num_correct_answers = challenge.num_correct_answers(correct, answers)
 
     opponent = (vs_dict['challenger'] if cuser_id == vs_dict['challenged']
@@ -917,17 +922,17 @@ def duel(_id):
             flash('Hacking much? Not appreciated. Thx.', 'error')
             return redirect(url_for('duel', _id=_id))
 
-        challenge.put_answer(db, cuser_id, _id, choice)
-
-        we_finished = challenge.num_answers_of(db, cuser_id, _id) == duel_len
-        opp_finished = challenge.num_answers_of(db, opponent, _id) == duel_len
+        state = challenge.submit_answer(db, vs_dict, cuser_id, choice)
 
-        if we_finished and opp_finished:
-            challenge.finish_duel(db, _id)
+        if state and state['winner']:
+            flash('Duel finished!')
 
         return redirect(url_for('duel_r', _id=_id))
 
-    we_finished = challenge.num_answers_of(db, cuser_id, _id) == duel_len
+    answers = challenge.answers_of(db, cuser_id, _id)
+    num_answers = len(answers)
+
+    we_finished = num_answers == duel_len
 
     cardbox_name = vs_dict['box_name']
 
@@ -938,19 +943,17 @@ def duel(_id):
                                duel_id=_id,
                                active='versus')
 
-    num_answers = challenge.num_answers_of(db, cuser_id, _id)
-    cardbox_size = challenge.duel_length(vs_dict)
+    challenge.load_content(db, vs_dict)
     card = challenge.get_card_from_duel(vs_dict, num_answers)
 
-    answers = challenge.answers_of(db, cuser_id, _id)
-    correct = vs_dict['box_content']['correct_answers'][:num_answers]
+    correct = challenge.correct_answers_of(vs_dict)[:num_answers]
     num_correct_answers = challenge.num_correct_answers(correct, answers)
 
     return render_template('duel.html',
                            opponent=opponent,
                            cardbox_name=cardbox_name,
                            card_number=num_answers + 1,
-                           cardbox_size=cardbox_size,
+                           cardbox_size=duel_len,
                            num_correct_answers=num_correct_answers,
                            number_answers=num_answers,
                            card=card,
@@ -971,17 +974,8 @@ def duel_result(_id):
 
     cardbox_size = challenge.duel_length(vs_dict)
 
-    correct = vs_dict['box_content']['correct_answers']
-    answers_challenger = challenge.answers_of(db, challenger, _id)
-    answers_challenged = challenge.answers_of(db, challenged, _id)
-
-    num_correct_challenger = challenge.num_correct_answers(correct,
-                                                           answers_challenger)
-    num_correct_challenged = challenge.num_correct_answers(correct,
-                                                           answers_challenged)
-
-    bool_challenger = challenge.check_answer_list(correct, answers_challenger)
-    bool_challenged = challenge.check_answer_list(correct, answers_challenged)
+    correct = challenge.correct_answers_of(vs_dict)
+    summary = challenge.result_summary(db, vs_dict)
 
     time_stamp = utils.unix_time_to_iso(vs_dict['finish_time'])
 
@@ -991,16 +985,11 @@ def duel_result(_id):
                            box_name=vs_dict['box_name'],
                            box_id=vs_dict['box_id'],
                            cardbox_size=cardbox_size,
-                           num_correct_challenger=num_correct_challenger,
-                           num_correct_challenged=num_correct_challenged,
-                           bool_challenger=bool_challenger,
-                           bool_challenged=bool_challenged,
                            correct_answers=correct,
-                           answers_challenger=answers_challenger,
-                           answers_challenged=answers_challenged,
                            winner=vs_dict['winner'],
                            time_stamp=time_stamp,
-                           active='versus')
+                           active='versus',
+                           **summary)
 
 
 @app.route('/duel')
@@ -1011,26 +1000,69 @@ def duel_list():
 
     # <-- receive parameters -->
     location = args.get('location')
+    page = args.get('page')
 
     # <-- validate parameters and set fallback values -->
     location_possible = ('current', 'archive')
     location = location if location in location_possible else 'current'
 
+    page = page or 1  # equals 1 if None; else: stays the same
+    try:
+        page = int(page)
+    except ValueError:
+        page = 1
+
     def opponent_id_producer(item):
         if current_user._id == item.challenger:
             return item.challenged
         return item.challenger
 
+    pag_kwargs = None
+
     if location == 'archive':
 
-        duels = challenge.fetch_archived_duels(db, current_user._id)
+        duels = challenge.archive_source(db, current_user._id)
+
+        # <-- pagination -->
+        per_page = 50
+        duel_count = len(duels)
+        page_range = utils.page_range(total_count=duel_count,
+                                      per_page=per_page)
+        page = (page if page in page_range else 1)
+
+        pagination = utils.Pagination(parent=duels,
+                                      page=page,
+                                      per_page=per_page,
+                                      total_count=duel_count)
+
+        # <-- standard values-->
+        kwargs = {key: value for key, value in args.items()}
+        kwargs.update(location=location, page=page)
+
+        pag_kwargs = dict(pagination=pagination, endpoint='duel_list',
+                          prev='<', next='>', ellipses='...', size='lg',
+                          args=kwargs)
 
         def time_stamp_producer(item):
             return utils.unix_time_to_iso(item.finish_time)
 
+        def score_producer(item):
+            scores = item.raw.get('scores')
+
+            if not scores:
+                return ''
+
+            own, other = scores
+
+            if current_user._id == item.challenged:
+                own, other = other, own
+
+            return f'{own} : {other}'
+
         wrapper = utils.TableItemWrapper(dict(partner_id=opponent_id_producer,
-                                              time=time_stamp_producer))
-        table = DuelArchiveTable(wrapper(duels))
+                                              time=time_stamp_producer,
+                                              score=score_producer))
+        table = DuelArchiveTable(wrapper(pagination.items))
 
     else:
         duels = challenge.fetch_duels_of(db, current_user._id)
@@ -1038,7 +1070,9 @@ def duel_list():
         table = DuelTable(wrapper(duels))
 
     return render_template('duel_list.html', table=table,
-                           location=location, active='versus')
+                           location=location,
+                           pagination_kwargs=pag_kwargs,
+                           active='versus')
 
 
 """
@@ -1122,7 +1156,7 @@ def add_cardbox():
                 cardbox_id = box._id
                 break
         else:
-            user.cardboxs.append(cardbox_id)
+            user.add_cardbox(db, cardbox_id)
 
         # store content in separate redis table
         Card.save_content(db, cardbox_id, payload['content'])
@@ -1133,8 +1167,6 @@ def add_cardbox():
                           tags=payload['tags'])
 
         new_box.store(db)
-        user.store(db)
-        User.update_score(db, user._id)
 
     return 'OK'
 
@@ -1156,19 +1188,28 @@ def sync_score():
     if not payload['secret'] == SCORE_SYNC_SECRET:
         abort(404)
 
+    # bool is an int subclass
+    score = payload['score']
+    if not isinstance(score, int) or isinstance(score, bool):
+        abort(404)
+
     if User.exists(db, payload['username']):
         user = User.fetch(db, payload['username'])
         if not user.check_password(payload['password']):
             abort(404)
 
-        user.offline_score = payload['score']
-        user.store(db)
-
-        User.update_score(db, user._id)
+        user.update_fields(db, offline_score=score)
 
     return 'OK'
 
 
+@app.route('/cache_stats')
+@login_required
+def cache_stats():
+    # counters of the record cache in the worker serving this request
+    return jsonify(records.stats())
+
+
 @app.route('/cardboxes/<_id>/prepare-download')
 def prepare_download(_id: str):
     return render_template('prepare_download.html', box_id=_id)
@@ -1258,11 +1299,11 @@ def update_notifications(user):
     if not user:
         return
 
-    user_id = user._id
+    counts = challenge.notification_counts(db, user._id)
 
-    session['counter_ch_in'] = challenge.num_incoming_challenges(db, user_id)
-    session['counter_ch_out'] = challenge.num_outgoing_challenges(db, user_id)
-    session['counter_duels'] = challenge.num_duels(db, user_id)
+    session['counter_ch_in'] = counts['incoming']
+    session['counter_ch_out'] = counts['outgoing']
+    session['counter_duels'] = counts['duels']
 
 
 @login_manager.user_loader
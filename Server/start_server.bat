@@ -1,3 +1,5 @@
 python -m ensurepip
 python -m pip install -r requirements.txt
+start python score_worker.py
+start python duel_sweeper.py
 python server.py
\ No newline at end of file
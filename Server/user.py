@@ -1,3 +1,7 @@
+import json
+import logging
+
+import redis
 from flask_wtf import FlaskForm
 from wtforms import StringField, PasswordField, BooleanField, SubmitField
 from wtforms.validators import (ValidationError, DataRequired, Email,
@@ -5,26 +9,123 @@ from wtforms.validators import (ValidationError, DataRequired, Email,
 from werkzeug.security import generate_password_hash, check_password_hash
 
 import utils
-from model import CardBox
+from cache import records, fetch_objects
+from model import (CardBox, TABLE_CARDBOXES, TABLE_RATINGS, INDEX_RATING,
+                   RATERS_SUFFIX)
+
 
+logger = logging.getLogger(__name__)
 
+# registry of all user ids; legacy values are whole json user documents
 TABLE_USER = 'users'
 TABLE_SCORE = 'score'
+TABLE_FOLLOWER_COUNTS = 'follower_counts'
+
+# registry value of users stored field by field
+REGISTERED = '1'
+
+# hash of the scalar fields of a user
+PROFILE_SUFFIX = '_profile'
+# list of own box ids, set of followed user ids, set of rated box ids
+CARDBOXS_SUFFIX = '_cardboxs'
+FOLLOWING_SUFFIX = '_following'
+RATED_SUFFIX = '_rated'
+
+FOLLOWERS_SUFFIX = '_followers'
+
+PROFILE_FIELDS = ('password_hash', 'offline_score', 'showcase')
+
+SCORE_PER_RATING = 100
+SCORE_PER_FOLLOWER = 200
+SCORE_PER_CARDBOX = 100
+
+# Users whose score needs a recompute, coalesced by the set and handled by
+#   score_worker.py; the signal list holds at most one token to wake it up.
+TABLE_DIRTY_SCORES = 'dirty_scores'
+DIRTY_SCORES_SIGNAL = 'dirty_scores_signal'
+
+# KEYS: following set of follower, followers set of followed user,
+#       follower counts
+# ARGV: follower id, followed id, 1 to follow or 0 to unfollow
+_FOLLOW_SCRIPT = utils.LuaScript("""
+if ARGV[3] == '1' then
+    redis.call('SADD', KEYS[1], ARGV[2])
+    if redis.call('SADD', KEYS[2], ARGV[1]) == 1 then
+        redis.call('HINCRBY', KEYS[3], ARGV[2], 1)
+    end
+else
+    redis.call('SREM', KEYS[1], ARGV[2])
+    if redis.call('SREM', KEYS[2], ARGV[1]) == 1 then
+        redis.call('HINCRBY', KEYS[3], ARGV[2], -1)
+    end
+end
+return redis.call('HGET', KEYS[3], ARGV[2])
+""")
+
+# Rates a box once per user: counts the rating, moves the box in the rating
+#   index, adds to the score of the owner and adds the user to the raters of
+#   the box. Returns 0 if the box does not exist or was already rated by the
+#   user.
+# The owner is queued for a recompute as well (see User.mark_score_dirty),
+#   a recompute running concurrently may have overwritten the increment.
+# KEYS: boxes, ratings, rating index, rated set of the user, scores,
+#       raters set of the box, dirty scores, dirty scores signal
+# ARGV: box id, owner id, score per rating, user id
+_RATE_SCRIPT = utils.LuaScript("""
+if redis.call('HEXISTS', KEYS[1], ARGV[1]) == 0 or
+        redis.call('SADD', KEYS[4], ARGV[1]) == 0 then
+    return 0
+end
+redis.call('SADD', KEYS[6], ARGV[4])
+redis.call('HINCRBY', KEYS[2], ARGV[1], 1)
+redis.call('ZINCRBY', KEYS[3], 1, ARGV[1])
+redis.call('ZINCRBY', KEYS[5], ARGV[3], ARGV[2])
+redis.call('SADD', KEYS[7], ARGV[2])
+redis.call('LPUSH', KEYS[8], 1)
+redis.call('LTRIM', KEYS[8], 0, 0)
+return 1
+""")
+
+# Splits a legacy json user document, unless it changed meanwhile.
+# KEYS: registry, profile hash, cardboxs list, following set, rated set
+# ARGV: user id, legacy document, json list of profile fields and values,
+#       json lists of box ids, followed user ids and rated box ids,
+#       new registry value
+_MIGRATE_SCRIPT = utils.LuaScript("""
+if redis.call('HGET', KEYS[1], ARGV[1]) ~= ARGV[2] then
+    return 0
+end
+redis.call('DEL', KEYS[2], KEYS[3], KEYS[4], KEYS[5])
+local profile = cjson.decode(ARGV[3])
+for i = 1, #profile, 2 do
+    redis.call('HSET', KEYS[2], profile[i], profile[i + 1])
+end
+for _, box_id in ipairs(cjson.decode(ARGV[4])) do
+    redis.call('RPUSH', KEYS[3], box_id)
+end
+for _, user_id in ipairs(cjson.decode(ARGV[5])) do
+    redis.call('SADD', KEYS[4], user_id)
+end
+for _, box_id in ipairs(cjson.decode(ARGV[6])) do
+    redis.call('SADD', KEYS[5], box_id)
+end
+redis.call('HSET', KEYS[1], ARGV[1], ARGV[7])
+return 1
+""")
 
 
 class User:
 
-    def __init__(self, _id: str, password_hash=None, cardboxs=[], rated=[],
-                 offline_score=0, following=[], showcase=None,
+    def __init__(self, _id: str, password_hash=None, cardboxs=None,
+                 offline_score=0, following=None, showcase=None,
                  is_active=None, is_authenticated=None, is_anonymous=None):
 
         self._id = _id
         self.password_hash = password_hash
 
-        self.cardboxs = cardboxs
-        self.rated = rated
+        self.cardboxs = cardboxs or []
         self.offline_score = offline_score
-        self.following = following
+        self.following = following or []
         self.showcase = showcase or dict(info='', cardbox='',
                                          show_info=False,
                                          show_cardbox=False,
@@ -44,22 +145,143 @@ class User:
         return check_password_hash(self.password_hash, password_plain)
 
     def store(self, db):
-        db.hset(TABLE_USER, self._id, utils.jsonify(self))
-
-    def toggle_follow(self, _id):
-        if (_id in self.following):
-            self.following.remove(_id)
-        else:
+        """ Writes the whole user, meant for new users only;
+          changes go through the field and collection methods below.
+        """
+        pipe = db.pipeline()
+        pipe.delete(self._id + PROFILE_SUFFIX, self._id + CARDBOXS_SUFFIX,
+                    self._id + FOLLOWING_SUFFIX)
+
+        for field, value in _encode_profile(vars(self)).items():
+            pipe.hset(self._id + PROFILE_SUFFIX, field, value)
+
+        if self.cardboxs:
+            pipe.rpush(self._id + CARDBOXS_SUFFIX, *self.cardboxs)
+        if self.following:
+            pipe.sadd(self._id + FOLLOWING_SUFFIX, *self.following)
+
+        pipe.hset(TABLE_USER, self._id, REGISTERED)
+        records.invalidate(pipe, TABLE_USER, self._id)
+        pipe.execute()
+
+    def update_fields(self, db, **fields):
+        """ Sets and stores only the given PROFILE_FIELDS. """
+        pipe = db.pipeline()
+
+        for field, value in _encode_profile(fields).items():
+            pipe.hset(self._id + PROFILE_SUFFIX, field, value)
+
+        if 'offline_score' in fields:
+            User.mark_score_dirty(pipe, self._id)
+
+        records.invalidate(pipe, TABLE_USER, self._id)
+        pipe.execute()
+
+        for field, value in fields.items():
+            setattr(self, field, value)
+
+    def add_cardbox(self, db, cardbox_id: str):
+        pipe = db.pipeline()
+        pipe.rpush(self._id + CARDBOXS_SUFFIX, cardbox_id)
+        User.mark_score_dirty(pipe, self._id)
+        records.invalidate(pipe, TABLE_USER, self._id)
+        pipe.execute()
+
+        self.cardboxs.append(cardbox_id)
+
+    def remove_cardbox(self, db, cardbox_id: str):
+        pipe = db.pipeline()
+        pipe.lrem(self._id + CARDBOXS_SUFFIX, 0, cardbox_id)
+        User.mark_score_dirty(pipe, self._id)
+        records.invalidate(pipe, TABLE_USER, self._id)
+        pipe.execute()
+
+        if cardbox_id in self.cardboxs:
+            self.cardboxs.remove(cardbox_id)
+
+    def delete_cardbox(self, db, cardbox_id: str):
+        """ Deletes an own box together with the references to it: the
+          rated sets of the users who rated it and the showcase.
+        """
+        raters = CardBox.delete(db, cardbox_id)
+
+        pipe = db.pipeline()
+
+        for rater_id in raters:
+            pipe.srem(rater_id + RATED_SUFFIX, cardbox_id)
+
+        if self.showcase.get('cardbox') == cardbox_id:
+            self.showcase = dict(self.showcase, cardbox='',
+                                 show_cardbox=False)
+            pipe.hset(self._id + PROFILE_SUFFIX, 'showcase',
+                      _encode_profile(vars(self))['showcase'])
+
+        pipe.execute()
+
+        self.remove_cardbox(db, cardbox_id)
+
+    def toggle_follow(self, db, _id):
+        follow = 0 if _id in self.following else 1
+
+        pipe = db.pipeline()
+        _FOLLOW_SCRIPT(pipe, keys=[self._id + FOLLOWING_SUFFIX,
+                                   _id + FOLLOWERS_SUFFIX,
+                                   TABLE_FOLLOWER_COUNTS],
+                       args=[self._id, _id, follow])
+        User.mark_score_dirty(pipe, _id)
+        records.invalidate(pipe, TABLE_USER, self._id)
+        pipe.execute()
+
+        if follow:
             self.following.append(_id)
+        else:
+            self.following.remove(_id)
+
+    def rate(self, db, box) -> bool:
+        """ Rates the box, returns False if the user already did. """
+        pipe = db.pipeline()
+        _RATE_SCRIPT(pipe, keys=[TABLE_CARDBOXES, TABLE_RATINGS, INDEX_RATING,
+                                 self._id + RATED_SUFFIX, TABLE_SCORE,
+                                 box._id + RATERS_SUFFIX, TABLE_DIRTY_SCORES,
+                                 DIRTY_SCORES_SIGNAL],
+                     args=[box._id, box.owner, SCORE_PER_RATING, self._id])
+        records.invalidate(pipe, TABLE_CARDBOXES, box._id)
+        rated, _ = pipe.execute()
+
+        if rated:
+            box.rating += 1
+
+        return bool(rated)
 
     def is_following(self, _id):
         return (_id in self.following)
 
+    @staticmethod
+    def num_followers(db, _id) -> int:
+        return int(db.hget(TABLE_FOLLOWER_COUNTS, _id) or 0)
+
     def get_score(self, db):
-        return int(db.zscore(TABLE_SCORE, self._id))
+        return int(db.zscore(TABLE_SCORE, self._id) or 0)
+
+    @staticmethod
+    def scores_of(db, user_ids: list) -> list:
+        """ Scores of several users in one round trip. """
+        pipe = db.pipeline(transaction=False)
+
+        for _id in user_ids:
+            pipe.zscore(TABLE_SCORE, _id)
+
+        return [int(score or 0) for score in pipe.execute()]
 
     def get_rank(self, db):
-        return db.zrevrank(TABLE_SCORE, self._id) + 1
+        rank = db.zrevrank(TABLE_SCORE, self._id)
+
+        if rank is None:
+            # not scored yet, the score worker adds the user
+            User.mark_score_dirty(db, self._id)
+            return db.zcard(TABLE_SCORE) + 1
+
+        return rank + 1
 
     def init_user_score(self, db):
         db.zadd(TABLE_SCORE, {self._id: 0})
@@ -71,12 +293,16 @@ class User:
         ranked_tuples = db.zrange(TABLE_SCORE, _from, to,
                                   desc=reverse, withscores=True)
 
-        for rank, (uid, score) in enumerate(ranked_tuples):
-            top_dicts.append(dict(rank=rank + 1,
+        for rank, (uid, score) in enumerate(ranked_tuples, start=_from + 1):
+            top_dicts.append(dict(rank=rank,
                                   _id=uid.decode('utf-8'), score=int(score)))
 
         return top_dicts
 
+    @staticmethod
+    def num_ranked(db) -> int:
+        return db.zcard(TABLE_SCORE)
+
     @staticmethod
     def update_score(db, _id) -> int:
         user = User.fetch(db, _id)
@@ -87,63 +313,330 @@ class User:
         for box in boxes:
             score_likes = score_likes + box.rating
 
-        score_followers = 0
-
-        users = User.fetch_all(db)
-        for u in users:
-            if u.is_following(user._id):
-                score_followers += 1
+        score_followers = User.num_followers(db, user._id)
 
         score_boxes = len(user.cardboxs)
 
-        score = (user.offline_score + score_likes * 100 +
-                 score_followers * 200 + score_boxes * 100)
+        score = (user.offline_score + score_likes * SCORE_PER_RATING +
+                 score_followers * SCORE_PER_FOLLOWER +
+                 score_boxes * SCORE_PER_CARDBOX)
 
         db.zadd(TABLE_SCORE, {_id: score})
 
         return score
 
     @staticmethod
-    def fetch(db, user_id: str):
-        if not user_id:
-            return None
+    def mark_score_dirty(db_or_pipe, *user_ids):
+        """ Queues a score recompute of the users for the score worker. """
+        db_or_pipe.sadd(TABLE_DIRTY_SCORES, *user_ids)
+        db_or_pipe.lpush(DIRTY_SCORES_SIGNAL, 1)
+        db_or_pipe.ltrim(DIRTY_SCORES_SIGNAL, 0, 0)
+
+    @staticmethod
+    def pop_dirty_scores(db, batch_size=100) -> list:
+        """ Takes up to 'batch_size' users off the recompute queue; users
+          queued again meanwhile are recomputed once more later.
+        """
+        return [_id.decode('utf-8')
+                for _id in db.spop(TABLE_DIRTY_SCORES, batch_size)]
 
-        json_string = db.hget(TABLE_USER, user_id)
+    @staticmethod
+    def update_scores(db, user_ids: list) -> list:
+        """ Recomputes the scores of the users, returns the ids of those
+          that failed: logged errors, or all that are left once redis is
+          unreachable. Put these back with requeue_scores.
+        """
+        for i, _id in enumerate(user_ids):
+            try:
+                if User.exists(db, _id):
+                    User.update_score(db, _id)
+            except redis.ConnectionError:
+                logger.exception('Lost the connection to redis')
+                return user_ids[i:]
+            except Exception:
+                logger.exception('Recomputing the score of %s failed', _id)
+                return [_id] + User.update_scores(db, user_ids[i + 1:])
+
+        return []
 
-        if not json_string:
+    @staticmethod
+    def requeue_scores(db, user_ids: list):
+        """ Queues the users again without waking the score workers. """
+        db.sadd(TABLE_DIRTY_SCORES, *user_ids)
+
+    @staticmethod
+    def wait_for_dirty_scores(db, timeout: int):
+        db.brpop(DIRTY_SCORES_SIGNAL, timeout=timeout)
+
+    @staticmethod
+    def fetch(db, user_id: str):
+        if not user_id:
             return None
 
-        return User(**utils.unjsonify(json_string))
+        return fetch_objects(db, TABLE_USER, [user_id], User,
+                             read=_read_users)[0]
 
     @staticmethod
     def fetch_multiple(db, user_ids: list):
         if not user_ids:
             return []
 
-        json_strings = db.hmget(TABLE_USER, *user_ids)
+        return [user for user in
+                fetch_objects(db, TABLE_USER, user_ids, User,
+                              read=_read_users)
+                if user]
 
-        if not json_strings:
-            return []
+    @staticmethod
+    def fetch_all(db):
+        return User.fetch_multiple(db, [_id.decode('utf-8')
+                                        for _id in db.hkeys(TABLE_USER)])
+
+    @staticmethod
+    def migrate_users(db, batch_size=500) -> int:
+        """ Splits all legacy json user documents; fetching a user does the
+          same lazily.
+        """
+        count = 0
+        legacy_ids = []
 
-        return [User(**utils.unjsonify(json_string))
-                for json_string in json_strings]
+        for user_id, value in db.hscan_iter(TABLE_USER, count=batch_size):
+            if value.startswith(b'{'):
+                legacy_ids.append(user_id.decode('utf-8'))
+
+        for i in range(0, len(legacy_ids), batch_size):
+            batch = legacy_ids[i:i + batch_size]
+            count += len([r for r in _read_users(db, batch) if r])
+
+        return count
 
     @staticmethod
-    def fetch_all(db):
-        dict_json_users = db.hgetall(TABLE_USER)
+    def rebuild_followers(db, batch_size=500) -> int:
+        """ Rebuilds follower sets and counts from the 'following' lists. """
+        pipe = db.pipeline()
+        pipe.delete(TABLE_FOLLOWER_COUNTS)
 
-        if not dict_json_users:
-            return []
+        for user_id, _ in db.hscan_iter(TABLE_USER, count=batch_size):
+            pipe.delete(user_id.decode('utf-8') + FOLLOWERS_SUFFIX)
+
+        pipe.execute()
 
-        users = [User(**utils.unjsonify(d))
-                 for d in dict_json_users.values()]
+        count = 0
+        user_ids = [user_id.decode('utf-8')
+                    for user_id, _ in db.hscan_iter(TABLE_USER,
+                                                    count=batch_size)]
 
-        return users
+        for i in range(0, len(user_ids), batch_size):
+            for user in User.fetch_multiple(db, user_ids[i:i + batch_size]):
+                for _id in set(user.following):
+                    pipe.sadd(_id + FOLLOWERS_SUFFIX, user._id)
+                    pipe.hincrby(TABLE_FOLLOWER_COUNTS, _id, 1)
+
+                count += 1
+
+            pipe.execute()
+
+        return count
 
     @staticmethod
     def exists(db, user_id: str) -> bool:
         return db.hexists(TABLE_USER, user_id)
 
+    @staticmethod
+    def scan_references(db, cursor=0, repair=False, batch_size=100):
+        """ Visits one HSCAN batch of users and counts their references to
+          boxes that do not exist: own boxes, rated boxes and the showcase.
+        'repair' drops these references and adds the users to the raters
+          sets of their rated boxes, which boxes rated before raters sets
+          existed lack.
+        Returns the next cursor, 0 after the last batch, and the counts;
+          'raters' counts the missing raters set entries.
+        """
+        cursor, batch = db.hscan(TABLE_USER, cursor, count=batch_size)
+        counts = dict(scanned=len(batch), cardboxs=0, rated=0, showcase=0,
+                      raters=0)
+
+        # legacy json users are split by migrate-users first
+        user_ids = [_id.decode('utf-8') for _id, registered in batch.items()
+                    if not registered.startswith(b'{')]
+
+        pipe = db.pipeline(transaction=False)
+
+        for _id in user_ids:
+            pipe.lrange(_id + CARDBOXS_SUFFIX, 0, -1)
+            pipe.smembers(_id + RATED_SUFFIX)
+            pipe.hget(_id + PROFILE_SUFFIX, 'showcase')
+
+        results = pipe.execute()
+        references = {}
+        showcases = {}
+
+        for i, _id in enumerate(user_ids):
+            cardboxs, rated, showcase = results[3 * i:3 * i + 3]
+            cardbox = json.loads(showcase).get('cardbox') if showcase else ''
+
+            references[_id] = dict(
+                cardboxs=[b.decode('utf-8') for b in cardboxs],
+                rated=[b.decode('utf-8') for b in rated],
+                showcase=[cardbox] if cardbox else [])
+            showcases[_id] = showcase
+
+        box_ids = sorted({box_id for refs in references.values()
+                          for ids in refs.values() for box_id in ids})
+        existing = {box_id for box_id, exists in
+                    zip(box_ids, CardBox.exists_multiple(db, box_ids))
+                    if exists}
+
+        repairs = db.pipeline()
+        backfill = db.pipeline(transaction=False)
+
+        for _id, refs in references.items():
+            dangling = {field: [box_id for box_id in ids
+                                if box_id not in existing]
+                        for field, ids in refs.items()}
+
+            for field, ids in dangling.items():
+                counts[field] += len(ids)
+
+            for box_id in refs['rated']:
+                if box_id in existing and repair:
+                    backfill.sadd(box_id + RATERS_SUFFIX, _id)
+                elif box_id in existing:
+                    backfill.sismember(box_id + RATERS_SUFFIX, _id)
+
+            if dangling['rated']:
+                repairs.srem(_id + RATED_SUFFIX, *dangling['rated'])
+
+            for box_id in dangling['cardboxs']:
+                repairs.lrem(_id + CARDBOXS_SUFFIX, 0, box_id)
+
+            if dangling['cardboxs']:
+                User.mark_score_dirty(repairs, _id)
+
+            if dangling['showcase']:
+                showcase = json.loads(showcases[_id])
+                showcase.update(cardbox='', show_cardbox=False)
+                # unless the user changed the showcase meanwhile
+                utils.REPLACE_FIELD_SCRIPT(
+                    repairs, keys=[_id + PROFILE_SUFFIX],
+                    args=['showcase', showcases[_id],
+                          _encode_profile(dict(showcase=showcase))
+                          ['showcase']])
+
+            if dangling['cardboxs'] or dangling['showcase']:
+                records.invalidate(repairs, TABLE_USER, _id)
+
+        if repair:
+            repairs.execute()
+
+        results = backfill.execute()
+        counts['raters'] = sum(results) if repair else results.count(False)
+
+        return cursor, counts
+
+
+def _encode_profile(fields: dict) -> dict:
+    encoded = {}
+
+    for field in PROFILE_FIELDS:
+        if fields.get(field) is None:
+            continue
+
+        if field == 'showcase':
+            encoded[field] = json.dumps(fields[field])
+        else:
+            encoded[field] = fields[field]
+
+    return encoded
+
+
+def _decode_profile(profile: dict) -> dict:
+    fields = {key.decode('utf-8'): value.decode('utf-8')
+              for key, value in profile.items()}
+
+    if 'offline_score' in fields:
+        fields['offline_score'] = _offline_score(fields['offline_score'])
+    if 'showcase' in fields:
+        fields['showcase'] = json.loads(fields['showcase'])
+
+    return fields
+
+
+def _offline_score(value: str) -> int:
+    # legacy documents and old syncs may hold floats or garbage
+    try:
+        return int(value)
+    except ValueError:
+        pass
+
+    try:
+        return int(float(value))
+    except (ValueError, OverflowError):
+        return 0
+
+
+def _read_users(db, user_ids: list) -> list:
+    """ Reads users as constructor kwargs, None for unknown ids, in one
+      round trip; legacy json documents get split on the way.
+    """
+    pipe = db.pipeline(transaction=False)
+
+    for _id in user_ids:
+        pipe.hget(TABLE_USER, _id)
+        pipe.hgetall(_id + PROFILE_SUFFIX)
+        pipe.lrange(_id + CARDBOXS_SUFFIX, 0, -1)
+        pipe.smembers(_id + FOLLOWING_SUFFIX)
+
+    results = pipe.execute()
+    users = []
+
+    for i, _id in enumerate(user_ids):
+        registered, profile, cardboxs, following = results[4 * i:4 * i + 4]
+
+        if not registered:
+            users.append(None)
+        elif registered.startswith(b'{'):
+            users.append(_migrate_user(db, _id, registered))
+        else:
+            users.append(dict(_decode_profile(profile), _id=_id,
+                              cardboxs=[b.decode('utf-8') for b in cardboxs],
+                              following=sorted(f.decode('utf-8')
+                                               for f in following)))
+
+    return users
+
+
+def _migrate_user(db, _id: str, document: bytes) -> dict:
+    legacy = utils.unjsonify(document)
+
+    profile = [item for pair in _encode_profile(legacy).items()
+               for item in pair]
+
+    _MIGRATE_SCRIPT(db, keys=[TABLE_USER, _id + PROFILE_SUFFIX,
+                              _id + CARDBOXS_SUFFIX, _id + FOLLOWING_SUFFIX,
+                              _id + RATED_SUFFIX],
+                    args=[_id, document, json.dumps(profile),
+                          json.dumps(legacy.get('cardboxs', [])),
+                          json.dumps(legacy.get('following', [])),
+                          json.dumps(legacy.get('rated', [])),
+                          REGISTERED])
+
+    return {key: value for key, value in legacy.items()
+            if key in ('_id', 'cardboxs', 'following') + PROFILE_FIELDS}
+
+
+class ScoreboardView(utils.PageSource):
+    """ Ranked user dicts of the 'score' zset, fetched lazily. """
+
+    def __init__(self, db, reverse=True):
+        self.db = db
+        self.reverse = reverse
+
+    def count(self) -> int:
+        return User.num_ranked(self.db)
+
+    def fetch(self, _from: int, to: int) -> list:
+        return User.top_user_dicts(self.db, _from, to, self.reverse)
+
 
 class RegistrationForm(FlaskForm):
 
@@ -5,6 +5,7 @@ import math
 import time
 import hashlib
 
+import msgpack
 from PIL import Image
 from flask import url_for
 from werkzeug.datastructures import FileStorage
@@ -19,13 +20,81 @@ def jsonify(obj: object):
     return json.dumps(vars(obj))
 
 
+class LuaScript:
+    """ Lua script that is registered on first use and then run via EVALSHA.
+    Can be called with a redis client or a pipeline.
+    """
+
+    def __init__(self, source: str):
+        self.source = source
+        self.script = None
+
+    def __call__(self, db, keys=[], args=[]):
+        if self.script is None:
+            self.script = db.register_script(self.source)
+
+        return self.script(keys=keys, args=args, client=db)
+
+
+# Serialized records start with a version byte naming their format;
+#   records starting with '{' are legacy json documents.
+# To add a format, register its version byte and point RECORD_FORMAT at it.
+SERIALIZERS = {
+    b'\x01': (lambda record: msgpack.packb(record, use_bin_type=True),
+               lambda data: msgpack.unpackb(data, raw=False)),
+}
+RECORD_FORMAT = b'\x01'
+
+
+def encode_record(record: dict) -> bytes:
+    dumps, _ = SERIALIZERS[RECORD_FORMAT]
+    return RECORD_FORMAT + dumps(record)
+
+
+def decode_record(data: bytes) -> dict:
+    if data[:1] == b'{':
+        return unjsonify(data)
+
+    _, loads = SERIALIZERS[data[:1]]
+    return loads(data[1:])
+
+
+def is_outdated(data: bytes) -> bool:
+    """ Whether the record should be rewritten in RECORD_FORMAT. """
+    return data[:1] != RECORD_FORMAT
+
+
+# Replaces a hash field only if it still holds the expected value,
+#   e.g. to rewrite records lazily without losing concurrent writes.
+# KEYS: hash
+# ARGV: field, expected value, new value
+REPLACE_FIELD_SCRIPT = LuaScript("""
+if redis.call('HGET', KEYS[1], ARGV[1]) ~= ARGV[2] then
+    return 0
+end
+redis.call('HSET', KEYS[1], ARGV[1], ARGV[3])
+return 1
+""")
+
+
 def clean_boxes(db):
-    db.hdel('cardboxs', *db.hgetall('cardboxs').keys())
-    db.hdel('ratings', *db.hgetall('ratings').keys())
+    _clean_table(db, 'cardboxs')
+    _clean_table(db, 'ratings')
 
 
 def clean_users(db):
-    db.hdel('users', *db.hgetall('users').keys())
+    _clean_table(db, 'users')
+
+
+def _clean_table(db, table: str, batch_size=500):
+    # deletes in HSCAN batches instead of one HGETALL of the whole table
+    cursor = None
+
+    while cursor != 0:
+        cursor, batch = db.hscan(table, cursor or 0, count=batch_size)
+
+        if batch:
+            db.hdel(table, *batch.keys())
 
 
 def page_range(total_count: int, per_page: int):
@@ -43,17 +112,119 @@ def unix_time_to_iso(unix_time: int) -> str:
     return time.strftime(TIME_FORMAT_STRING, time.localtime(unix_time))
 
 
+class PageSource:
+    """ Base class for lazily fetched sequences that can be passed to
+      Pagination instead of a fully materialized list.
+    Subclasses implement count() and fetch(_from, to), where 'to' is
+      inclusive and -1 means 'until the end', like in redis range commands.
+    """
+
+    def count(self) -> int:
+        raise NotImplementedError()
+
+    def fetch(self, _from: int, to: int) -> list:
+        raise NotImplementedError()
+
+    def __len__(self):
+        return self.count()
+
+    def __getitem__(self, key):
+        if (not isinstance(key, slice) or key.step not in (None, 1) or
+                (key.start or 0) < 0 or (key.stop or 0) < 0):
+            raise TypeError('PageSources only support non-negative slices.')
+
+        _from = key.start or 0
+
+        if key.stop is None:
+            return self.fetch(_from, -1)
+
+        if key.stop <= _from:
+            return []
+
+        return self.fetch(_from, key.stop - 1)
+
+
+class ListSource(PageSource):
+    """ An already computed list, e.g. of ids, whose items are only
+    turned into page items by 'loader' for the requested page.
+    """
+
+    def __init__(self, items: list, loader=None):
+        self.items = items
+        self.loader = loader
+
+    def count(self) -> int:
+        return len(self.items)
+
+    def fetch(self, _from: int, to: int) -> list:
+        page = self.items[_from:None if to == -1 else to + 1]
+        return self.loader(page) if self.loader else page
+
+
+class SortedSetSource(PageSource):
+    """ Members of a redis sorted set in ascending (or reverse) order.
+    ZCARD gives the count, ZRANGE the page; 'loader' turns the page's
+      members (decoded strings) into page items.
+    """
+
+    def __init__(self, db, key: str, reverse=False, loader=None):
+        self.db = db
+        self.key = key
+        self.reverse = reverse
+        self.loader = loader
+
+    def count(self) -> int:
+        return self.db.zcard(self.key)
+
+    def fetch(self, _from: int, to: int) -> list:
+        members = [m.decode('utf-8') for m in
+                   self.db.zrange(self.key, _from, to, desc=self.reverse)]
+        return self.loader(members) if self.loader else members
+
+
+class RedisListSource(PageSource):
+    """ Elements of a redis list, from the tail if 'reverse' is set
+    (newest first for RPUSHed lists).
+    LLEN gives the count, LRANGE the page; 'loader' turns the page's
+      elements (decoded strings) into page items.
+    """
+
+    def __init__(self, db, key: str, reverse=False, loader=None):
+        self.db = db
+        self.key = key
+        self.reverse = reverse
+        self.loader = loader
+
+    def count(self) -> int:
+        return self.db.llen(self.key)
+
+    def fetch(self, _from: int, to: int) -> list:
+        if self.reverse:
+            elements = self.db.lrange(self.key, -to - 1, -_from - 1)
+            elements.reverse()
+        else:
+            elements = self.db.lrange(self.key, _from, to)
+
+        elements = [e.decode('utf-8') for e in elements]
+        return self.loader(elements) if self.loader else elements
+
+
 class Pagination:
+    """ 'parent' may be a plain list or a PageSource (see above) that only
+      fetches the items of the requested page; 'total_count' defaults to
+      the length of 'parent'.
+    """
 
     def __init__(self, parent: object,
                  page: int, per_page: int,
-                 total_count: int):
+                 total_count: int = None):
 
         self.parent = parent
 
         self.page = page
         self.per_page = per_page
-        self.total_count = total_count
+        self.total_count = (len(parent) if total_count is None
+                            else total_count)
 
         self.items = None
         self._init_items()